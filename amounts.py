@@ -0,0 +1,46 @@
+import re
+
+# Amount option keys: (currency, guaranteed minimum or None, bucket)
+AMOUNT_KEYS = {
+    "amt_1": ("UZS", None, "uzs_lt_300m"),  # Up to 300 mln so'm
+    "amt_3": ("UZS", None, "uzs_lt_10b"),  # Up to 10 mlrd so'm
+    "amt_4": ("USD", 300_000.0, "usd_gte_300k"),  # From 300 000 USD
+    "amt_5": ("UZS", 10_000_000_000.0, "uzs_gte_10b"),  # Over 10 mlrd so'm
+}
+
+# Manually entered amounts are in USD for Islamic financing and in so'm for
+# large credits; cash credits accept both, and nobody asks for less than a
+# million so'm, so smaller numbers are taken as dollars
+USD_BELOW = {"fin_1": float("inf"), "fin_2": 1_000_000.0, "fin_3": 0.0}
+
+SUFFIXES = {"k": 1e3, "m": 1e6, "mln": 1e6, "b": 1e9, "mlrd": 1e9}
+
+
+def amount_bucket(value: float, currency: str):
+    if currency == "USD":
+        return "usd_gte_300k" if value >= 300_000 else "usd_lt_300k"
+    if value >= 10_000_000_000:
+        return "uzs_gte_10b"
+    return "uzs_lt_10b" if value >= 300_000_000 else "uzs_lt_300m"
+
+
+# (amount_value, currency, amount_bucket) for an amount option key or a
+# number typed by the user; (None, None, None) if it is neither
+def normalize_amount(financing_type, amount):
+    if amount in AMOUNT_KEYS:
+        currency, value, bucket = AMOUNT_KEYS[amount]
+        return value, currency, bucket
+    try:
+        value = float(amount)
+    except (TypeError, ValueError):
+        return None, None, None
+    currency = "USD" if value < USD_BELOW.get(financing_type, 0.0) else "UZS"
+    return value, currency, amount_bucket(value, currency)
+
+
+# "300000", "300k", "10mlrd", "1.5b" -> float
+def parse_amount(text: str) -> float:
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([a-z]*)", text.strip().lower().replace("_", ""))
+    if not match or match.group(2) not in ("", *SUFFIXES):
+        raise ValueError(f"Bad amount: {text}")
+    return float(match.group(1)) * SUFFIXES.get(match.group(2), 1)
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import time
+
+from db import Database
+
+
+# Periodically moves old applications out of the hot table in small
+# batches, each its own short transaction on the DB thread, then gives the
+# freed pages back with incremental vacuum, a step at a time.
+class Archiver:
+    def __init__(
+        self,
+        db: Database,
+        interval: float = 3600.0,
+        processed_days: int = 30,
+        max_age_days: int = 180,
+        batch_size: int = 500,
+        vacuum_pages: int = 1000,
+        pause: float = 0.1,
+    ):
+        self.db = db
+        self.interval = interval
+        self.processed_days = processed_days
+        self.max_age_days = max_age_days
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.pause = pause  # Between batches, so user writes get their turn
+        self._task = None
+        self.archived = 0
+        self.runs = 0
+
+    async def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logging.exception(f"Archiving failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        started = time.monotonic()
+        moved = 0
+        while True:
+            count = await self.db.archive_applications(self.processed_days, self.max_age_days, self.batch_size)
+            moved += count
+            if count < self.batch_size:
+                break
+            await asyncio.sleep(self.pause)
+        if moved:
+            while await self.db.incremental_vacuum(self.vacuum_pages) > 0:
+                await asyncio.sleep(self.pause)
+        self.archived += moved
+        self.runs += 1
+        logging.info("Archived %s applications in %.1fs", moved, time.monotonic() - started)
+        return moved
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return {"archived": self.archived, "runs": self.runs}
@@ -0,0 +1,214 @@
+"""Offline benchmark of the whole Form funnel.
+
+Feeds synthetic updates for thousands of concurrent users through
+dp.feed_update against a fake Bot session and temporary SQLite files, then
+reports handler latency, throughput and DB queries per application.
+
+    python3 bench.py --users 2000 --output bench_output.txt
+
+With --api-budget the run fails when a completed application costs more
+Telegram API calls on average than the budget.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+# main.py reads its configuration at import time
+_tmp = tempfile.mkdtemp(prefix="credit_bot_bench_")
+os.environ["DB_PATH"] = os.path.join(_tmp, "bench.db")
+os.environ["FSM_DB_PATH"] = os.path.join(_tmp, "bench_fsm.db")
+os.environ["FILES_DIR"] = os.path.join(_tmp, "files")
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+# Measure the handlers, not Telegram's flood limits
+os.environ.setdefault("OUTBOX_GLOBAL_RATE", "1000000000")
+os.environ.setdefault("OUTBOX_CHAT_RATE", "1000000000")
+os.environ.setdefault("OUTBOX_MAX_QUEUE", "100000000")
+
+import main  # noqa: E402
+import replies  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.fsm.storage.base import StorageKey  # noqa: E402
+from aiogram.methods import EditMessageText, SendMessage  # noqa: E402
+from aiogram.types import CallbackQuery, Chat, Contact, Message, Update, User  # noqa: E402
+
+USER_ID_BASE = 10_000_000
+
+
+# Answers every API call locally without touching the network
+class FakeSession(BaseSession):
+    def __init__(self):
+        super().__init__()
+        self.calls = Counter()
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if isinstance(method, (SendMessage, EditMessageText)):
+            return Message(
+                message_id=1,
+                date=datetime.now(),
+                chat=Chat(id=method.chat_id or 0, type="private"),
+                text=method.text
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class Updates:
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return User(id=user_id, is_bot=False, first_name="Bench", username=f"bench{user_id}")
+
+    def _message(self, user_id, **kwargs):
+        return Message(
+            message_id=next(self._ids),
+            date=datetime.now(),
+            chat=Chat(id=user_id, type="private"),
+            from_user=self._user(user_id),
+            **kwargs
+        )
+
+    def message(self, user_id, text=None, contact=None):
+        return Update(update_id=next(self._ids), message=self._message(user_id, text=text, contact=contact))
+
+    def callback(self, user_id, data):
+        return Update(update_id=next(self._ids), callback_query=CallbackQuery(
+            id=str(next(self._ids)),
+            from_user=self._user(user_id),
+            chat_instance=str(user_id),
+            message=self._message(user_id, text="..."),
+            data=data
+        ))
+
+    # One complete application, with the variations the handlers branch on
+    def funnel(self, user_id, rng):
+        lang = rng.choice(["uz", "ru"])
+        financing_type = rng.choice(["fin_1", "fin_2", "fin_3"])
+        steps = [
+            self.message(user_id, "/start"),
+            self.callback(user_id, f"lang_{lang}"),
+            self.message(user_id, f"Bench User {user_id}"),
+            self.callback(user_id, financing_type),
+        ]
+        if rng.random() < 0.5:
+            amount = {"fin_1": "350000", "fin_2": "5000000", "fin_3": "500000000"}[financing_type]
+            steps += [self.callback(user_id, "enter_amount"), self.message(user_id, amount)]
+        else:
+            amount = {"fin_1": "amt_4", "fin_2": "amt_1", "fin_3": "amt_5"}[financing_type]
+            steps.append(self.callback(user_id, amount))
+        collateral_type = rng.choice(["col_1", "col_2"])
+        steps += [
+            self.callback(user_id, "app_3"),
+            self.callback(user_id, collateral_type),
+            self.message(user_id, "Tashkent, 120 m2, 1.5 mlrd so'm"),
+            self.message(user_id, contact=Contact(
+                phone_number=f"+99890{user_id % 10_000_000:07d}",
+                first_name="Bench",
+                user_id=user_id
+            )),
+        ]
+        return steps
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run(users, think_time, seed):
+    session = FakeSession()
+    main.bot.session = session
+    rng = random.Random(seed)
+    updates = Updates()
+    latencies = []
+    per_handler = defaultdict(list)
+
+    # Both databases open on their own threads; count the funnel's queries,
+    # not the schema setup
+    await main.db.get_bot_state("bench")
+    await main.storage.get_state(StorageKey(bot_id=main.bot.id, chat_id=0, user_id=0))
+    main.db.queries = main.storage.queries = 0
+
+    async def user_flow(user_id):
+        for update in updates.funnel(user_id, rng):
+            started = time.perf_counter()
+            await main.dp.feed_update(main.bot, update)
+            elapsed = time.perf_counter() - started
+            latencies.append(elapsed)
+            kind = "message" if update.message else "callback_query"
+            per_handler[kind].append(elapsed)
+            if think_time:
+                await asyncio.sleep(rng.random() * think_time)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user_flow(USER_ID_BASE + i) for i in range(users)))
+    elapsed = time.perf_counter() - started
+    await main.db.flush()
+    await main.outbox.drain(60)
+    await replies.wait_answers()
+
+    applications = (await main.db.list_applications(users + 1))
+    completed = len(applications)
+    report = [
+        f"users: {users}",
+        f"updates: {len(latencies)} in {elapsed:.2f}s ({len(latencies) / elapsed:.0f} updates/sec)",
+        f"completed applications: {completed}",
+        f"handler latency p50: {1000 * percentile(latencies, 0.5):.2f} ms",
+        f"handler latency p99: {1000 * percentile(latencies, 0.99):.2f} ms",
+        f"handler latency mean: {1000 * statistics.fmean(latencies):.2f} ms",
+    ]
+    for kind, values in sorted(per_handler.items()):
+        report.append(
+            f"  {kind}: p50 {1000 * percentile(values, 0.5):.2f} ms, p99 {1000 * percentile(values, 0.99):.2f} ms"
+        )
+    report += [
+        f"DB queries per application: {main.db.queries / max(completed, 1):.1f}",
+        f"FSM storage queries per application: {main.storage.queries / max(completed, 1):.1f}",
+        f"API calls per application: {sum(session.calls.values()) / max(completed, 1):.1f} {dict(session.calls)}",
+        f"user cache: {main.db.user_cache.stats()}",
+        f"DB writes: {main.db.write_stats()}",
+    ]
+    return "\n".join(report), sum(session.calls.values()) / max(completed, 1)
+
+
+async def amain(args):
+    try:
+        report, api_calls = await run(args.users, args.think_time, args.seed)
+    finally:
+        await main.dp.emit_shutdown(bot=main.bot)
+        await main.db.close()
+        shutil.rmtree(_tmp, ignore_errors=True)
+    print(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+    if args.api_budget is not None and api_calls > args.api_budget:
+        print(f"API calls per application {api_calls:.1f} exceed the budget of {args.api_budget}")
+        return 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000, help="simulated concurrent users")
+    parser.add_argument("--think-time", type=float, default=0.0, help="max random pause between steps, seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the report to this file")
+    parser.add_argument("--api-budget", type=float, help="max API calls per completed application")
+    sys.exit(asyncio.run(amain(parser.parse_args())))
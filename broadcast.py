@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import time
+
+from aiogram.methods import SendMessage
+
+from db import Database
+from outbox import BROADCAST, Outbox
+
+
+# Sends one message to every user, localized by their language. Recipients
+# are read page by page on a user_id cursor and sent through the outbox on
+# the lowest priority lane, so the global flood limit is shared with, and
+# yields to, replies to users. Each page's results and the cursor are stored
+# before the next page starts, so a restarted bot resumes where it stopped.
+class Broadcaster:
+    def __init__(self, db: Database, outbox: Outbox, page_size: int = 100, default_language: str = "uz"):
+        self.db = db
+        self.outbox = outbox
+        self.page_size = page_size
+        self.default_language = default_language
+        self._tasks = {}
+        self._stopping = False
+
+    async def start(self, texts: dict, created_by: int) -> int:
+        broadcast_id = await self.db.create_broadcast(texts, created_by)
+        self._spawn(broadcast_id, texts, created_by, 0, 0, 0)
+        return broadcast_id
+
+    # Picks up broadcasts that were running when the bot stopped
+    async def resume(self):
+        for broadcast in await self.db.get_broadcasts("running"):
+            if broadcast[0] not in self._tasks:
+                logging.info("Resuming broadcast %s after user %s", broadcast[0], broadcast[3])
+                self._spawn(*broadcast)
+
+    def _spawn(self, broadcast_id, texts, created_by, last_user_id, sent, failed):
+        task = asyncio.create_task(self._run(broadcast_id, texts, created_by, last_user_id, sent, failed))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _run(self, broadcast_id, texts, created_by, last_user_id, sent, failed):
+        started = time.monotonic()
+        sent_now = 0
+        try:
+            while not self._stopping:
+                users = await self.db.list_users_after(last_user_id, self.page_size)
+                if not users:
+                    break
+                futures = [
+                    self.outbox.submit(SendMessage(
+                        chat_id=user_id,
+                        text=texts.get(language) or texts[self.default_language]
+                    ), priority=BROADCAST)
+                    for user_id, language in users
+                ]
+                outcomes = await asyncio.gather(*futures, return_exceptions=True)
+                results = [
+                    (user_id, str(outcome)[:200] if isinstance(outcome, Exception) else None)
+                    for (user_id, _), outcome in zip(users, outcomes)
+                ]
+                last_user_id = users[-1][0]
+                await self.db.record_broadcast_page(broadcast_id, results, last_user_id)
+                page_failed = sum(1 for _, error in results if error)
+                sent += len(results) - page_failed
+                sent_now += len(results) - page_failed
+                failed += page_failed
+            else:
+                # Stopped for shutdown, resumed on the next start
+                return
+        except Exception as e:
+            logging.exception(f"Broadcast {broadcast_id} stopped: {e}")
+            return
+
+        await self.db.finish_broadcast(broadcast_id)
+        elapsed = time.monotonic() - started
+        report = (
+            f"📣 #{broadcast_id}: ✅ {sent} ❌ {failed}, "
+            f"{elapsed:.0f}s ({sent_now / elapsed if elapsed else 0:.1f}/s)"
+        )
+        logging.info(report)
+        if created_by:
+            self.outbox.submit(SendMessage(chat_id=created_by, text=report))
+
+    # Lets running broadcasts finish their current page, then stops them
+    async def close(self, timeout: float = 30.0):
+        self._stopping = True
+        tasks = list(self._tasks.values())
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        return {"running": len(self._tasks)}
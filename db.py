@@ -0,0 +1,488 @@
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from amounts import normalize_amount
+from cache import TTLCache
+from metrics import DB_SECONDS
+from migrations import apply_pragmas, enable_incremental_vacuum, migrate
+
+# Transaction bookkeeping, not counted as queries
+CONTROL_STATEMENTS = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE", "PRAGMA")
+
+# Columns copied from applications to applications_archive
+ARCHIVED_COLUMNS = (
+    "id, user_id, financing_type, amount, amount_value, currency, amount_bucket, "
+    "applicant_type, collateral_type, collateral_details, status, created_at"
+)
+
+
+# All sqlite work runs on one dedicated thread that owns the connection,
+# so handlers only await and the event loop never blocks on disk I/O.
+#
+# Writes are write-behind: they are buffered and committed together in one
+# transaction every `commit_interval` seconds or `commit_batch` writes.
+# Reads first push the buffered writes to the DB thread, so they always
+# see them.
+#
+# Processes sharing the file pass the same multiprocessing lock as
+# `write_lock`, so only one of them writes at a time: two deferred
+# transactions upgrading to writers at once would fail with SQLITE_BUSY
+# instead of waiting for busy_timeout.
+class Database:
+    def __init__(
+        self,
+        path: str,
+        cache_size: int = 10000,
+        cache_ttl: float = 300.0,
+        sqlite_cache_kib: int = 65536,
+        commit_interval: float = 0.02,
+        commit_batch: int = 200,
+        write_lock=None,
+    ):
+        self.path = path
+        self.sqlite_cache_kib = sqlite_cache_kib
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self.write_lock = write_lock or nullcontext()
+        self._conn = None
+        # (full_name, phone, language) rows keyed by user_id
+        self.user_cache = TTLCache(cache_size, cache_ttl)
+        # Buffered writes: (fn, args, durable, future)
+        self._writes = []
+        self._flush_event = asyncio.Event()  # A full batch is waiting
+        self._wake = asyncio.Event()  # Something is buffered
+        self._flush_task = None
+        self._batches = 0
+        self._batch_rows = 0
+        self._max_batch = 0
+        self._flush_time = 0.0
+        self._max_flush_time = 0.0
+        self.queries = 0  # Statements executed, bookkeeping aside, for benchmarks and metrics
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        # Queued first, so every later call sees an initialized schema
+        self._executor.submit(self._open)
+
+    def _open(self):
+        self._conn = sqlite3.connect(self.path)
+        self._conn.set_trace_callback(self._count_query)
+        apply_pragmas(self._conn, self.sqlite_cache_kib)
+        enable_incremental_vacuum(self._conn)
+        migrate(self._conn)
+
+    def _count_query(self, statement):
+        if not statement.lstrip()[:9].upper().startswith(CONTROL_STATEMENTS):
+            self.queries += 1
+
+    def _timed(self, fn, *args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, fn.__name__.lstrip("_"))
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        self._submit_writes()
+        return await loop.run_in_executor(self._executor, self._timed, fn, *args)
+
+    # Group commit
+    def _write(self, fn, *args, durable=False) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        if not durable:
+            # Nobody awaits these, so report failures here
+            future.add_done_callback(self._log_failure)
+        self._writes.append((fn, args, durable, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        self._wake.set()
+        if len(self._writes) >= self.commit_batch:
+            self._flush_event.set()
+        return future
+
+    def _log_failure(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f"Database write failed: {future.exception()}")
+
+    def _commit_batch(self, batch):
+        started = time.perf_counter()
+        durable = any(op[2] for op in batch)
+        results = []
+        with self.write_lock:
+            try:
+                if durable:
+                    # Applications must survive a power loss before we confirm them
+                    self._conn.execute("PRAGMA synchronous=FULL")
+                self._conn.execute("BEGIN")
+                for fn, args, _, _ in batch:
+                    # A failing write only undoes itself, not the whole batch
+                    self._conn.execute("SAVEPOINT write")
+                    try:
+                        results.append((self._timed(fn, *args), None))
+                        self._conn.execute("RELEASE write")
+                    except Exception as e:
+                        self._conn.execute("ROLLBACK TO write")
+                        self._conn.execute("RELEASE write")
+                        results.append((None, e))
+                self._timed(self._conn.commit)
+            except Exception:
+                self._conn.rollback()
+                raise
+            finally:
+                if durable:
+                    self._conn.execute("PRAGMA synchronous=NORMAL")
+        return results, time.perf_counter() - started
+
+    def _submit_writes(self):
+        if not self._writes:
+            return None
+        batch, self._writes = self._writes, []
+        loop = asyncio.get_running_loop()
+        pending = loop.run_in_executor(self._executor, self._commit_batch, batch)
+
+        def done(task):
+            futures = [op[3] for op in batch]
+            if task.exception() is not None:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(task.exception())
+                return
+            results, elapsed = task.result()
+            self._batches += 1
+            self._batch_rows += len(batch)
+            self._max_batch = max(self._max_batch, len(batch))
+            self._flush_time += elapsed
+            self._max_flush_time = max(self._max_flush_time, elapsed)
+            for future, (result, error) in zip(futures, results):
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+        pending.add_done_callback(done)
+        return pending
+
+    async def flush(self):
+        pending = self._submit_writes()
+        if pending is not None:
+            await asyncio.wait([pending])
+
+    async def _flush_loop(self):
+        while True:
+            if not self._writes:
+                # Idle until the next write, the commit window starts then
+                self._wake.clear()
+                await self._wake.wait()
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), self.commit_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self.flush()
+
+    def write_stats(self):
+        return {
+            "pending": len(self._writes),
+            "batches": self._batches,
+            "rows": self._batch_rows,
+            "avg_batch": self._batch_rows / self._batches if self._batches else 0.0,
+            "max_batch": self._max_batch,
+            "avg_flush_ms": 1000 * self._flush_time / self._batches if self._batches else 0.0,
+            "max_flush_ms": 1000 * self._max_flush_time,
+        }
+
+    # Reads
+    async def get_language(self, user_id: int):
+        user = await self.get_user(user_id)
+        return user[2] if user else None
+
+    def _get_user(self, user_id):
+        return self._conn.execute(
+            "SELECT full_name, phone, language FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+
+    async def get_user(self, user_id: int):
+        user = self.user_cache.get(user_id)
+        if user is None:
+            user = await self._run(self._get_user, user_id)
+            if user is not None:
+                self.user_cache.set(user_id, user)
+        return user
+
+    def _list_applications(self, limit, before, after):
+        query = """
+        SELECT a.id, u.full_name, u.username, a.financing_type, a.amount, a.applicant_type,
+               a.collateral_type, a.collateral_details, a.status, a.created_at
+        FROM applications a
+        JOIN users u ON a.user_id = u.user_id
+        """
+        if after is not None:
+            rows = self._conn.execute(
+                query + "WHERE (a.created_at, a.id) > (?, ?) ORDER BY a.created_at, a.id LIMIT ?",
+                (*after, limit)
+            ).fetchall()
+            rows.reverse()
+            return rows
+        if before is not None:
+            return self._conn.execute(
+                query + "WHERE (a.created_at, a.id) < (?, ?) ORDER BY a.created_at DESC, a.id DESC LIMIT ?",
+                (*before, limit)
+            ).fetchall()
+        return self._conn.execute(
+            query + "ORDER BY a.created_at DESC, a.id DESC LIMIT ?", (limit,)
+        ).fetchall()
+
+    # Newest first, keyset-paginated on (created_at, id): `before` returns the
+    # page of older rows, `after` the page of newer rows than the given key
+    async def list_applications(self, limit: int, before: tuple = None, after: tuple = None):
+        return await self._run(self._list_applications, limit, before, after)
+
+    def _search_applications(self, match, limit, offset):
+        return self._conn.execute("""
+        SELECT a.id, u.full_name, u.username, u.phone, a.financing_type, a.amount,
+               a.status, a.created_at
+        FROM applications_fts f
+        JOIN applications a ON a.id = f.rowid
+        JOIN users u ON u.user_id = a.user_id
+        WHERE applications_fts MATCH ?
+        ORDER BY f.rank
+        LIMIT ? OFFSET ?
+        """, (match, limit, offset)).fetchall()
+
+    # Best matches first for a free-text query over name, username, phone and
+    # collateral details; every word is matched as a prefix
+    async def search_applications(self, query: str, limit: int, offset: int = 0):
+        words = re.findall(r"\w+", query)
+        if not words:
+            return []
+        match = " ".join('"' + word + '"*' for word in words)
+        return await self._run(self._search_applications, match, limit, offset)
+
+    def _list_users_after(self, user_id, limit):
+        return self._conn.execute(
+            "SELECT user_id, language FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+            (user_id, limit)
+        ).fetchall()
+
+    # Keyset page of (user_id, language) over the users primary key
+    async def list_users_after(self, user_id: int, limit: int):
+        return await self._run(self._list_users_after, user_id, limit)
+
+    def _get_broadcasts(self, status):
+        rows = self._conn.execute(
+            "SELECT id, texts, created_by, last_user_id, sent, failed FROM broadcasts WHERE status = ? ORDER BY id",
+            (status,)
+        ).fetchall()
+        return [(row[0], json.loads(row[1]), *row[2:]) for row in rows]
+
+    # (id, texts, created_by, last_user_id, sent, failed) with `texts` decoded
+    async def get_broadcasts(self, status: str = "running"):
+        return await self._run(self._get_broadcasts, status)
+
+    def _get_application_stats(self, days):
+        rows = self._conn.execute("""
+        SELECT dimension, value, count FROM application_stats
+        WHERE dimension IN ('status', 'financing_type', 'applicant_type')
+        UNION ALL
+        SELECT dimension, value, count FROM application_stats
+        WHERE dimension = 'day' AND value >= date('now', ?)
+        """, (f"-{days - 1} days",)).fetchall()
+        stats = {}
+        for dimension, value, count in rows:
+            if count:
+                stats.setdefault(dimension, {})[value] = count
+        return stats
+
+    # {dimension: {value: count}} from the trigger-maintained counters; the
+    # cost does not depend on the number of applications
+    async def get_application_stats(self, days: int = 7):
+        return await self._run(self._get_application_stats, days)
+
+    def _get_bot_state(self, key):
+        row = self._conn.execute("SELECT value FROM bot_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    async def get_bot_state(self, key: str):
+        return await self._run(self._get_bot_state, key)
+
+    def _get_file(self, file_unique_id):
+        return self._conn.execute(
+            "SELECT sha256, size, kind, mime_type FROM files WHERE file_unique_id = ?", (file_unique_id,)
+        ).fetchone()
+
+    async def get_file(self, file_unique_id: str):
+        return await self._run(self._get_file, file_unique_id)
+
+    # Writes (buffered, see above)
+    def _add_user(self, user_id, username, language):
+        self._conn.execute(
+            "INSERT INTO users (user_id, username, language) VALUES (?, ?, ?)",
+            (user_id, username, language)
+        )
+
+    async def add_user(self, user_id: int, username, language: str = "uz"):
+        self._write(self._add_user, user_id, username, language)
+        self.user_cache.set(user_id, (None, None, language))
+
+    def _upsert_user(self, user_id, username, language):
+        self._conn.execute(
+            "INSERT OR IGNORE INTO users (user_id, username, language) VALUES (?, ?, ?)",
+            (user_id, username, language)
+        )
+        self._conn.execute(
+            "UPDATE users SET username = ?, language = ? WHERE user_id = ?",
+            (username, language, user_id)
+        )
+
+    async def upsert_user(self, user_id: int, username, language: str):
+        self._write(self._upsert_user, user_id, username, language)
+        self.user_cache.update(user_id, lambda user: (user[0], user[1], language))
+
+    def _set_full_name(self, user_id, full_name):
+        self._conn.execute(
+            "UPDATE users SET full_name = ? WHERE user_id = ?", (full_name, user_id)
+        )
+
+    async def set_full_name(self, user_id: int, full_name: str):
+        self._write(self._set_full_name, user_id, full_name)
+        self.user_cache.update(user_id, lambda user: (full_name, user[1], user[2]))
+
+    def _insert_application(self, user_id, phone, data):
+        self._conn.execute(
+            "UPDATE users SET phone = ? WHERE user_id = ?", (phone, user_id)
+        )
+        if "amount_bucket" in data:
+            amount = (data['amount_value'], data['currency'], data['amount_bucket'])
+        else:
+            # Forms started before amounts were normalized
+            amount = normalize_amount(data['financing_type'], data['amount'])
+        cur = self._conn.execute(
+            """INSERT INTO applications
+            (user_id, financing_type, amount, amount_value, currency, amount_bucket,
+             applicant_type, collateral_type, collateral_details, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (user_id, data['financing_type'], data['amount'], *amount,
+             data['applicant_type'], data['collateral_type'], data['collateral_details'], 'pending')
+        )
+        # Linked by id, the files themselves may still be downloading
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO application_files (application_id, file_unique_id) VALUES (?, ?)",
+            [(cur.lastrowid, file_unique_id) for file_unique_id in data.get('collateral_files', ())]
+        )
+        return cur.lastrowid
+
+    # Stores the phone and the application atomically and returns only once
+    # the batch holding them is durably committed
+    async def insert_application(self, user_id: int, phone: str, data: dict):
+        app_id = await self._write(self._insert_application, user_id, phone, data, durable=True)
+        self.user_cache.update(user_id, lambda user: (user[0], phone, user[2]))
+        return app_id
+
+    def _create_broadcast(self, texts, created_by):
+        cur = self._conn.execute(
+            "INSERT INTO broadcasts (texts, created_by) VALUES (?, ?)",
+            (json.dumps(texts, ensure_ascii=False), created_by)
+        )
+        return cur.lastrowid
+
+    async def create_broadcast(self, texts: dict, created_by: int):
+        return await self._write(self._create_broadcast, texts, created_by, durable=True)
+
+    def _record_broadcast_page(self, broadcast_id, results, last_user_id):
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO broadcast_recipients (broadcast_id, user_id, status, error) VALUES (?, ?, ?, ?)",
+            [(broadcast_id, user_id, "failed" if error else "sent", error) for user_id, error in results]
+        )
+        failed = sum(1 for _, error in results if error)
+        self._conn.execute(
+            "UPDATE broadcasts SET last_user_id = ?, sent = sent + ?, failed = failed + ? WHERE id = ?",
+            (last_user_id, len(results) - failed, failed, broadcast_id)
+        )
+
+    # Records one page of (user_id, error or None) and moves the cursor past it
+    async def record_broadcast_page(self, broadcast_id: int, results: list, last_user_id: int):
+        await self._write(self._record_broadcast_page, broadcast_id, results, last_user_id)
+
+    def _finish_broadcast(self, broadcast_id):
+        self._conn.execute(
+            "UPDATE broadcasts SET status = 'done', finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (broadcast_id,)
+        )
+
+    async def finish_broadcast(self, broadcast_id: int):
+        await self._write(self._finish_broadcast, broadcast_id)
+
+    def _set_bot_state(self, key, value):
+        self._conn.execute(
+            """INSERT INTO bot_state (key, value) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP""",
+            (key, value)
+        )
+
+    async def set_bot_state(self, key: str, value: str):
+        await self._write(self._set_bot_state, key, value)
+
+    def _archive_applications(self, processed_days, max_age_days, limit):
+        ids = [row[0] for row in self._conn.execute("""
+        SELECT id FROM applications
+        WHERE created_at < datetime('now', ?)
+          AND (status != 'pending' OR created_at < datetime('now', ?))
+        ORDER BY created_at, id
+        LIMIT ?
+        """, (f"-{min(processed_days, max_age_days)} days", f"-{max_age_days} days", limit))]
+        if not ids:
+            return 0
+        placeholders = ",".join("?" * len(ids))
+        self._conn.execute(
+            f"INSERT INTO applications_archive ({ARCHIVED_COLUMNS}) "
+            f"SELECT {ARCHIVED_COLUMNS} FROM applications WHERE id IN ({placeholders})",
+            ids
+        )
+        self._conn.execute(f"DELETE FROM applications WHERE id IN ({placeholders})", ids)
+        return len(ids)
+
+    # Moves up to `limit` of the oldest applications that are processed and
+    # older than `processed_days`, or older than `max_age_days` whatever their
+    # status, to applications_archive in one transaction; returns the count
+    async def archive_applications(self, processed_days: int, max_age_days: int, limit: int):
+        return await self._write(self._archive_applications, processed_days, max_age_days, limit)
+
+    def _incremental_vacuum(self, pages):
+        with self.write_lock:
+            self._conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        return self._conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    # Returns up to `pages` free pages to the OS; returns the free pages left
+    async def incremental_vacuum(self, pages: int = 1000):
+        await self.flush()
+        return await self._run(self._incremental_vacuum, pages)
+
+    def _add_file(self, file_unique_id, sha256, size, kind, mime_type):
+        self._conn.execute(
+            """INSERT OR IGNORE INTO files (file_unique_id, sha256, size, kind, mime_type)
+            VALUES (?, ?, ?, ?, ?)""",
+            (file_unique_id, sha256, size, kind, mime_type)
+        )
+
+    async def add_file(self, file_unique_id: str, sha256: str, size: int, kind: str, mime_type: str = None):
+        await self._write(self._add_file, file_unique_id, sha256, size, kind, mime_type)
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,88 @@
+import asyncio
+import html
+
+from aiogram.methods import SendMessage
+
+from outbox import NOTIFICATION, Outbox
+
+
+# html.escape(text) cut to at most `limit` characters, between entities
+def escape_truncated(text: str, limit: int, ellipsis: str = "…") -> str:
+    escaped = html.escape(text)
+    if len(escaped) <= limit:
+        return escaped
+    parts, size = [], len(ellipsis)
+    for char in text:
+        char = html.escape(char)
+        if size + len(char) > limit:
+            break
+        parts.append(char)
+        size += len(char)
+    return "".join(parts) + ellipsis
+
+
+# Packs entries into as few messages as possible without splitting one.
+# Entries are HTML and can't be cut safely, so each must fit in `limit`:
+# truncate the raw text before escaping it (escape_truncated).
+def split_messages(entries, limit: int = 4096, separator: str = "\n\n"):
+    messages, current = [], ""
+    for entry in entries:
+        if current and len(current) + len(separator) + len(entry) > limit:
+            messages.append(current)
+            current = entry
+        else:
+            current = current + separator + entry if current else entry
+    if current:
+        messages.append(current)
+    return messages
+
+
+# Collects notifications for one chat and sends them as a digest once per
+# `window` seconds, split at the message size limit. Urgent entries, and
+# everything when the window is 0, are sent right away.
+class NotificationDigest:
+    def __init__(self, outbox: Outbox, chat_id: int, window: float = 60.0, limit: int = 4096):
+        self.outbox = outbox
+        self.chat_id = chat_id
+        self.window = window
+        self.limit = limit
+        self._entries = []
+        self._timer = None
+        self.digests = 0
+        self.batched = 0
+        self.immediate = 0
+
+    def add(self, text: str, urgent: bool = False):
+        if urgent or self.window <= 0:
+            self.immediate += 1
+            self._send(text)
+            return
+        self._entries.append(text)
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        entries, self._entries = self._entries, []
+        if not entries:
+            return
+        self.batched += len(entries)
+        for text in split_messages(entries, self.limit):
+            self.digests += 1
+            self._send(text)
+
+    def _send(self, text):
+        self.outbox.submit(SendMessage(chat_id=self.chat_id, text=text), priority=NOTIFICATION)
+
+    async def close(self):
+        self.flush()
+
+    def stats(self):
+        return {
+            "pending": len(self._entries),
+            "digests": self.digests,
+            "batched": self.batched,
+            "immediate": self.immediate,
+        }
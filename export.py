@@ -0,0 +1,167 @@
+import asyncio
+import csv
+import io
+import sqlite3
+import tempfile
+from datetime import date
+
+from aiogram.types import InputFile
+
+from amounts import parse_amount
+
+try:
+    import openpyxl
+except ImportError:  # XLSX export is optional
+    openpyxl = None
+
+CHUNK_SIZE = 1000  # Rows fetched per round trip
+SPOOL_SIZE = 1024 * 1024  # Kept in memory up to 1 MiB, then spilled to disk
+
+COLUMNS = [
+    "id", "created_at", "status", "full_name", "username", "phone",
+    "financing_type", "amount", "amount_value", "currency", "applicant_type", "collateral_type", "collateral_details",
+]
+# Columns holding option keys, with the TEXTS group that describes them
+LABELED = {
+    "financing_type": "fin_types",
+    "amount": "amount_types",
+    "applicant_type": "app_types",
+    "collateral_type": "col_types",
+}
+FILTERS = {"from", "to", "status", "type", "currency", "min", "max", "bucket"}
+
+
+# "/export xlsx from=2024-01-01 to=2024-01-31 status=pending type=fin_1"
+# "/export currency=USD type=fin_1 min=300k", "/export currency=UZS min=10mlrd"
+# "/export archive from=2023-01-01" reads the archived applications instead
+def parse_args(args):
+    fmt, filters = "csv", {}
+    for arg in (args or "").split():
+        if arg.lower() in ("csv", "xlsx"):
+            fmt = arg.lower()
+            continue
+        if arg.lower() == "archive":
+            filters["archive"] = True
+            continue
+        key, sep, value = arg.partition("=")
+        if not sep or key not in FILTERS or not value:
+            raise ValueError(f"Unknown export argument: {arg}")
+        if key in ("from", "to"):
+            date.fromisoformat(value)  # Raises ValueError on bad dates
+        if key in ("min", "max"):
+            value = parse_amount(value)
+        if key == "currency":
+            value = value.upper()
+        filters[key] = value
+    if fmt == "xlsx" and openpyxl is None:
+        raise ValueError("XLSX export needs openpyxl installed")
+    return fmt, filters
+
+
+def _query(filters):
+    table = "applications_archive" if filters.get("archive") else "applications"
+    sql = f"""
+    SELECT a.id, a.created_at, a.status, u.full_name, u.username, u.phone,
+           a.financing_type, a.amount, a.amount_value, a.currency, a.applicant_type, a.collateral_type, a.collateral_details
+    FROM {table} a
+    JOIN users u ON a.user_id = u.user_id
+    """
+    where, params = [], []
+    if "from" in filters:
+        where.append("a.created_at >= ?")
+        params.append(filters["from"])
+    if "to" in filters:
+        where.append("a.created_at < date(?, '+1 day')")
+        params.append(filters["to"])
+    if "status" in filters:
+        where.append("a.status = ?")
+        params.append(filters["status"])
+    if "type" in filters:
+        where.append("a.financing_type = ?")
+        params.append(filters["type"])
+    if "currency" in filters:
+        where.append("a.currency = ?")
+        params.append(filters["currency"])
+    if "min" in filters:
+        where.append("a.amount_value >= ?")
+        params.append(filters["min"])
+    if "max" in filters:
+        where.append("a.amount_value <= ?")
+        params.append(filters["max"])
+    if "bucket" in filters:
+        where.append("a.amount_bucket = ?")
+        params.append(filters["bucket"])
+    if where:
+        sql += "WHERE " + " AND ".join(where) + "\n"
+    return sql + "ORDER BY a.created_at, a.id", params
+
+
+def _rows(conn, filters, labels):
+    cursor = conn.execute(*_query(filters))
+    indexes = {COLUMNS.index(column): group for column, group in LABELED.items()}
+    while chunk := cursor.fetchmany(CHUNK_SIZE):
+        for row in chunk:
+            if labels:
+                row = list(row)
+                for i, group in indexes.items():
+                    row[i] = labels[group].get(row[i], row[i])
+            yield row
+
+
+def _write_csv(rows, file):
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text)
+    writer.writerow(COLUMNS)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    text.flush()
+    text.detach()
+    return count
+
+
+def _write_xlsx(rows, file):
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("applications")
+    sheet.append(COLUMNS)
+    count = 0
+    for row in rows:
+        sheet.append(row)
+        count += 1
+    workbook.save(file)
+    return count
+
+
+def _export(db_path, filters, fmt, labels):
+    # A separate read-only connection: WAL lets it run next to the writer
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    try:
+        write = _write_xlsx if fmt == "xlsx" else _write_csv
+        count = write(_rows(conn, filters, labels), file)
+    except Exception:
+        file.close()
+        raise
+    finally:
+        conn.close()
+    file.seek(0)
+    return file, count
+
+
+# Streams matching applications into a spooled temporary file on a worker
+# thread. Returns the file positioned at the start and the row count.
+async def export_applications(db_path: str, filters: dict, fmt: str = "csv", labels: dict = None):
+    return await asyncio.to_thread(_export, db_path, filters, fmt, labels)
+
+
+# Uploads an open file in chunks without reading it into memory
+class SpooledInputFile(InputFile):
+    def __init__(self, file, filename: str, **kwargs):
+        super().__init__(filename=filename, **kwargs)
+        self.file = file
+
+    async def read(self, bot):
+        self.file.seek(0)
+        while chunk := await asyncio.to_thread(self.file.read, self.chunk_size):
+            yield chunk
@@ -0,0 +1,94 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+
+from aiogram import Bot
+
+from db import Database
+
+
+# Content-addressed store for collateral photos and documents. Files are
+# downloaded in the background, streamed in chunks to a temporary file while
+# being hashed, then moved to <root>/<sha[:2]>/<sha[2:4]>/<sha>. A file whose
+# file_unique_id is already stored is not downloaded again, and identical
+# content under another id is kept once.
+class FileStore:
+    def __init__(self, root: str, bot: Bot, db: Database, chunk_size: int = 65536):
+        self.root = root
+        self.bot = bot
+        self.db = db
+        self.chunk_size = chunk_size
+        os.makedirs(root, exist_ok=True)
+        self._downloads = {}
+        self.downloaded = 0
+        self.deduplicated = 0
+        self.failed = 0
+        self.bytes = 0
+
+    def path(self, sha256: str):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    # Returns at once, the download runs as a background task
+    def intake(self, file_id: str, file_unique_id: str, kind: str, mime_type: str = None):
+        if file_unique_id in self._downloads:
+            self.deduplicated += 1
+            return
+        task = asyncio.create_task(self._fetch(file_id, file_unique_id, kind, mime_type))
+        self._downloads[file_unique_id] = task
+        task.add_done_callback(lambda _: self._downloads.pop(file_unique_id, None))
+
+    async def _fetch(self, file_id, file_unique_id, kind, mime_type):
+        try:
+            if await self.db.get_file(file_unique_id) is not None:
+                self.deduplicated += 1
+                return
+            sha256, size = await self._download(file_id)
+            await self.db.add_file(file_unique_id, sha256, size, kind, mime_type)
+            self.downloaded += 1
+            self.bytes += size
+        except Exception as e:
+            self.failed += 1
+            logging.error(f"Failed to store file {file_unique_id}: {e}")
+
+    async def _download(self, file_id):
+        file = await self.bot.get_file(file_id)
+        url = self.bot.session.api.file_url(self.bot.token, file.file_path)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".part")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as out:
+                async for chunk in self.bot.session.stream_content(url, chunk_size=self.chunk_size):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    await asyncio.to_thread(out.write, chunk)
+            sha256 = digest.hexdigest()
+            path = self.path(sha256)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return sha256, size
+
+    async def close(self, timeout: float = 30.0):
+        tasks = list(self._downloads.values())
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        return {
+            "downloading": len(self._downloads),
+            "downloaded": self.downloaded,
+            "deduplicated": self.deduplicated,
+            "failed": self.failed,
+            "bytes": self.bytes,
+        }
@@ -0,0 +1,75 @@
+import json
+import logging
+import os
+from collections.abc import Mapping
+
+
+# Leaves placeholders that are only known at send time untouched
+class _KeepMissing(dict):
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+
+# One language's messages; keys it lacks come from the default language
+class Messages(dict):
+    def __init__(self, messages, fallback=None):
+        super().__init__(messages)
+        self.fallback = fallback
+
+    def __missing__(self, key):
+        if self.fallback is None:
+            raise KeyError(key)
+        return self.fallback[key]
+
+
+# Translation catalogs in <directory>/<lang>.json, listed with their display
+# names in <directory>/languages.json. A language is read and compiled on
+# first use only: static parameters (e.g. the bot username) are substituted
+# once, so lookups are plain dict reads. Indexing works like a dict of
+# languages: TEXTS[lang]["welcome"], TEXTS[lang]["fin_types"]["fin_1"].
+class Catalog(Mapping):
+    def __init__(self, directory: str, default: str = "uz", params: dict = None, on_load=None):
+        self.directory = directory
+        self.default = default
+        self.params = _KeepMissing(params or {})
+        self.on_load = on_load  # Called with the language after it is loaded
+        with open(os.path.join(directory, "languages.json"), encoding="utf-8") as f:
+            self.names = json.load(f)
+        self._languages = {}
+
+    def __getitem__(self, lang):
+        messages = self._languages.get(lang)
+        if messages is None:
+            if lang not in self.names:
+                raise KeyError(lang)
+            messages = self._languages[lang] = self._load(lang)
+            if self.on_load is not None:
+                self.on_load(lang)
+        return messages
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _load(self, lang):
+        with open(os.path.join(self.directory, f"{lang}.json"), encoding="utf-8") as f:
+            messages = self._compile(json.load(f))
+        if lang == self.default:
+            return Messages(messages)
+        fallback = self[self.default]
+        # Nothing looks these up, so they are most likely misspelled
+        unknown = sorted(messages.keys() - fallback.keys())
+        if unknown:
+            logging.warning("Keys of %s.json not in %s.json: %s", lang, self.default, ", ".join(unknown))
+        return Messages(messages, fallback)
+
+    def _compile(self, value):
+        if isinstance(value, dict):
+            return {key: self._compile(item) for key, item in value.items()}
+        return value.format_map(self.params)
+
+    # Values of `key` in the languages loaded so far
+    def loaded_values(self, key):
+        return {messages[key] for messages in self._languages.values()}
@@ -0,0 +1,44 @@
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+from pydantic import ConfigDict, field_serializer
+
+
+# aiogram's markups and buttons can be changed in place, which would change a
+# cached keyboard for every user. These frozen variants reject assignment and
+# keep their rows in tuples, and are sent exactly like the originals.
+class FrozenInlineKeyboardButton(InlineKeyboardButton):
+    model_config = ConfigDict(frozen=True)
+
+
+class FrozenInlineKeyboardMarkup(InlineKeyboardMarkup):
+    model_config = ConfigDict(frozen=True)
+
+    inline_keyboard: tuple[tuple[FrozenInlineKeyboardButton, ...], ...]
+
+    # aiogram only turns lists into JSON arrays when sending
+    @field_serializer("inline_keyboard", mode="wrap")
+    def _rows(self, rows, handler):
+        return [list(row) for row in handler(rows)]
+
+
+class FrozenKeyboardButton(KeyboardButton):
+    model_config = ConfigDict(frozen=True)
+
+
+class FrozenReplyKeyboardMarkup(ReplyKeyboardMarkup):
+    model_config = ConfigDict(frozen=True)
+
+    keyboard: tuple[tuple[FrozenKeyboardButton, ...], ...]
+
+    @field_serializer("keyboard", mode="wrap")
+    def _rows(self, rows, handler):
+        return [list(row) for row in handler(rows)]
+
+
+FROZEN = {
+    InlineKeyboardMarkup: FrozenInlineKeyboardMarkup,
+    ReplyKeyboardMarkup: FrozenReplyKeyboardMarkup,
+}
+
+
+def freeze(markup):
+    return FROZEN[type(markup)].model_validate(markup.model_dump())
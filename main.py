@@ -1,81 +1,171 @@
 import os
+import html
+import secrets
+import signal
 import logging
-import sqlite3
 import asyncio
+from functools import lru_cache
 from pathlib import Path
 from dotenv import load_dotenv
 
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.enums import ParseMode, ContentType
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.types import (
     Message,
     CallbackQuery,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     ReplyKeyboardMarkup,
-    ReplyKeyboardRemove
+    ReplyKeyboardRemove,
+    Update
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
+from aiogram.webhook.aiohttp_server import setup_application
+from aiohttp import web
+
+from amounts import normalize_amount
+from archive import Archiver
+from broadcast import Broadcaster
+from db import Database
+from digest import NotificationDigest, escape_truncated
+from files import FileStore
+from i18n import Catalog
+from keyboards import freeze
+from export import SpooledInputFile, export_applications, parse_args as parse_export_args
+from metrics import APPLICATIONS, REGISTRY, ApiMetricsMiddleware, HandlerMetricsMiddleware, metrics_handler
+from outbox import Outbox
+from profiler import SamplingProfiler
+from replies import ReplyPlan, answer_callback
+from scheduler import UpdateScheduler, drain_backlog, poll_updates
+from storage import SQLiteStorage
+from supervisor import Supervisor, serve_shard, shard_of
 
 # Config
 load_dotenv(Path('.')/'.env')
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = 7945724174  # YOUR TELEGRAM ID HERE
 BOT_USERNAME = "@kreditbozori07"
+ADMIN_PAGE_SIZE = 10  # Applications per admin page
+STATS_DAYS = 7  # Days listed in the admin statistics
+MESSAGE_LIMIT = 4096  # Telegram message length limit
+NAME_LIMIT = 256  # Escaped length of a name in admin notifications
+DB_PATH = os.getenv("DB_PATH", "credit_bot.db")
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+SQLITE_CACHE_KIB = int(os.getenv("SQLITE_CACHE_KIB", "65536"))
+DB_COMMIT_INTERVAL = float(os.getenv("DB_COMMIT_INTERVAL_MS", "20")) / 1000  # Group commit window
+DB_COMMIT_BATCH = int(os.getenv("DB_COMMIT_BATCH", "200"))  # Commit early after this many writes
+FSM_DB_PATH = os.getenv("FSM_DB_PATH", "fsm_storage.db")
+FSM_SESSION_TTL = float(os.getenv("FSM_SESSION_TTL", str(7 * 24 * 3600)))  # Abandoned forms expire after a week
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))  # Messages per second, all chats
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))  # Messages per second, one chat
+OUTBOX_MAX_QUEUE = int(os.getenv("OUTBOX_MAX_QUEUE", "10000"))
+ADMIN_DIGEST_WINDOW = float(os.getenv("ADMIN_DIGEST_WINDOW", "60"))  # Seconds new applications are batched; 0 sends each at once
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "100"))  # Recipients sent and recorded together
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))  # Seconds between archiver runs, 0 disables it
+ARCHIVE_PROCESSED_DAYS = int(os.getenv("ARCHIVE_PROCESSED_DAYS", "30"))  # Processed applications older than this
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))  # Any application older than this
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "64"))  # Users served in parallel
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "10000"))
+WORKERS = int(os.getenv("WORKERS", "1"))  # Worker processes; more than 1 starts a supervisor (see supervisor.py)
+WORKER_INDEX = os.getenv("WORKER_INDEX")  # Set by the supervisor in its workers
+
+# Webhook mode is used when WEBHOOK_URL is set, long polling otherwise
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Public base URL, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Telegram sends it with every update; required in webhook mode, since every
+# instance registers it and a per-process secret would lock the others out
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise SystemExit("WEBHOOK_SECRET must be set when WEBHOOK_URL is")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Prometheus /metrics and /health, also served by the webhook app; 0 disables it when polling
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+LOCALES_DIR = os.getenv("LOCALES_DIR", str(Path(__file__).parent / "locales"))
+FILES_DIR = os.getenv("FILES_DIR", "collateral_files")  # Content-addressed store for collateral photos and documents
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")  # Collapsed stack files written by /profile and SIGUSR1
+PROFILE_SECONDS = float(os.getenv("PROFILE_SECONDS", "30"))  # Default profiling window
+
+SUPERVISOR = WORKERS > 1 and WORKER_INDEX is None
+# Broadcasts and archiving run in one process: the worker that gets the admin's updates
+LEADER = WORKERS <= 1 or (WORKER_INDEX is not None and int(WORKER_INDEX) == shard_of(ADMIN_ID, WORKERS))
+if WORKER_INDEX is not None:
+    OUTBOX_GLOBAL_RATE /= WORKERS  # Telegram's limit is per bot, the workers split it
 
 # Init
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-storage = MemoryStorage()
+storage = SQLiteStorage(FSM_DB_PATH, session_ttl=FSM_SESSION_TTL)
 dp = Dispatcher(storage=storage)
+outbox = Outbox(
+    bot,
+    global_rate=OUTBOX_GLOBAL_RATE,
+    chat_rate=OUTBOX_CHAT_RATE,
+    max_queue=OUTBOX_MAX_QUEUE
+)
 
 # DB Setup
-def init_db():
-    conn = sqlite3.connect("credit_bot.db", check_same_thread=False)
-    cursor = conn.cursor()
-    
-    # Create users table with username column
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        full_name TEXT,
-        username TEXT,
-        phone TEXT,
-        language TEXT DEFAULT 'uz',
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP
-    )
-    """)
-
-    # Create applications table
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS applications (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        financing_type TEXT,
-        amount TEXT,
-        applicant_type TEXT,
-        collateral_type TEXT,
-        collateral_details TEXT,
-        status TEXT DEFAULT 'pending',
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY(user_id) REFERENCES users(user_id)
-    )
-    """)
-    
-    # Try to add username column if it doesn't exist (for existing databases)
-    try:
-        cursor.execute("ALTER TABLE users ADD COLUMN username TEXT")
-    except sqlite3.OperationalError:
-        pass  # Column already exists
-    
-    conn.commit()
-    return conn, cursor
+db = Database(
+    DB_PATH,
+    cache_size=USER_CACHE_SIZE,
+    cache_ttl=USER_CACHE_TTL,
+    sqlite_cache_kib=SQLITE_CACHE_KIB,
+    commit_interval=DB_COMMIT_INTERVAL,
+    commit_batch=DB_COMMIT_BATCH
+)
+
+# In a worker the supervisor keeps the offset, and the pipe from it is the
+# queue: updates held in the scheduler would be lost if the worker crashed
+scheduler = UpdateScheduler(
+    dp,
+    bot,
+    workers=UPDATE_WORKERS,
+    max_pending=UPDATE_MAX_PENDING if WORKER_INDEX is None else UPDATE_WORKERS,
+    db=db if WORKER_INDEX is None else None
+)
+
+file_store = FileStore(FILES_DIR, bot, db)
+dp.shutdown.register(file_store.close)
 
-conn, cursor = init_db()
+archiver = Archiver(
+    db,
+    interval=ARCHIVE_INTERVAL,
+    processed_days=ARCHIVE_PROCESSED_DAYS,
+    max_age_days=ARCHIVE_AFTER_DAYS
+)
+if LEADER:
+    dp.startup.register(archiver.start)
+dp.shutdown.register(archiver.close)
+
+broadcaster = Broadcaster(db, outbox, page_size=BROADCAST_PAGE_SIZE)
+if LEADER:
+    dp.startup.register(broadcaster.resume)
+# Broadcasts stop at a page boundary before the outbox drains
+dp.shutdown.register(broadcaster.close)
+admin_digest = NotificationDigest(outbox, ADMIN_ID, window=ADMIN_DIGEST_WINDOW, limit=MESSAGE_LIMIT)
+dp.shutdown.register(admin_digest.close)
+profiler = SamplingProfiler(dp, PROFILE_DIR)
+dp.shutdown.register(profiler.close)
+dp.shutdown.register(outbox.close)
+
+# Metrics
+bot.session.middleware(ApiMetricsMiddleware())
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+REGISTRY.callback("bot_update_duplicates_total", "Redelivered updates skipped", lambda: update_sink.duplicates, type="counter")
+REGISTRY.callback("bot_update_queue_depth", "Updates waiting or running in the scheduler", lambda: scheduler.pending)
+REGISTRY.callback("bot_outbox_depth", "Messages waiting in the outbox", lambda: outbox.depth)
+REGISTRY.callback("bot_outbox_dropped_total", "Messages rejected by a full outbox", lambda: outbox.dropped, type="counter")
+REGISTRY.callback("bot_outbox_retried_total", "Sends retried after RetryAfter", lambda: outbox.retried, type="counter")
+REGISTRY.callback("bot_admin_digest_pending", "Applications waiting for the next admin digest", lambda: admin_digest.stats()["pending"])
+REGISTRY.callback("bot_db_pending_writes", "Writes waiting for the next group commit", lambda: db.write_stats()["pending"])
+REGISTRY.callback("bot_db_queries_total", "Database statements executed, transaction bookkeeping aside", lambda: db.queries, type="counter")
+REGISTRY.callback("bot_user_cache_hits_total", "User cache hits", lambda: db.user_cache.hits, type="counter")
+REGISTRY.callback("bot_user_cache_misses_total", "User cache misses", lambda: db.user_cache.misses, type="counter")
 
 # States
 class Form(StatesGroup):
@@ -90,94 +180,36 @@ class Form(StatesGroup):
     phone = State()
 
 # Texts
-TEXTS = {
-    "uz": {
-        "welcome": "👋 Assalomu alaykum! Kredit botiga xush kelibsiz. Tilni tanlang:",
-        "full_name": "📝 Familiya va ismingizni kiriting:",
-        "financing_type": "💵 Qanday turdagi moliyalashtirishni xohlaysiz?",
-        "amount": "💰 Qancha miqdorda mablag' kerak?",
-        "applicant_type": "👤 Kim uchun moliyalashtirish kerak?",
-        "collateral_type": "🏠 Qanday garov kafolati berasiz?",
-        "collateral_house": "🏡 Ko'chmas mulk haqida ma'lumot kiriting (manzil, maydoni, qimmatligi):",
-        "collateral_car": "🚗 Transport vositasi haqida ma'lumot kiriting (markasi, modeli, yili, qimmatligi):",
-        "phone": "📱 Telefon raqamingizni kiriting yoki 'Raqamni yuborish' tugmasini bosing:",
-        "phone_button": "📱 Raqamni yuborish",
-        "finish": f"✅ Ushbu xizmat bepul, bank xodimi tez orada siz bilan bog'lanadi. Rahmat! {BOT_USERNAME}",
-        "large_amount": "💼 10 mlrd so'mdan ortiq kreditlar uchun korporativ kreditlash bo'yicha menejer siz bilan shaxsan bog'lanadi.",
-        "contact_shared": "✅ Telefon raqamingiz qabul qilindi!",
-        "admin_panel": "⚙️ Admin paneli",
-        "applications": "📄 Barcha arizalar",
-        "back": "🔙 Orqaga",
-        "fin_types": {
-            "fin_1": "🕌 Islomiy moliyalashtirish 300 000,0 AQSh dollardan",
-            "fin_2": "💵 Naqd pul krediti 300 mln so'mgacha",
-            "fin_3": "🏦 300 mln so'mdan ortiq kredit"
-        },
-        "amount_types": {
-            "amt_1": "💵 Naqd pul krediti 300 mln so'mgacha",
-            "amt_3": "🏢 Aylanma mablag'larni to'ldirish yoki asosiy vositalarni sotib olish uchun 10 mlrd so'mgacha",
-            "amt_4": "🕌 Islomiy moliyalashtirish 300 000,0 AQSh dollardan",
-            "amt_5": "🏦 Turli maqsadlar uchun 10 mlrd so'mdan ortiq moliyalashtirish"
-        },
-        "app_types": {
-            "app_1": "👤 O'zim uchun (jismoniy shaxs)",
-            "app_2": "📝 Patent, mening yakka tartibdagi tadbirkorligim bor",
-            "app_3": "🏢 Firma uchun"
-        },
-        "col_types": {
-            "col_1": "🏠 Ko'chmas mulk",
-            "col_2": "🚗 Transport vositalari"
-        }
-    },
-    "ru": {
-        "welcome": "👋 Здравствуйте! Добро пожаловать в кредитного бота. Выберите язык:",
-        "full_name": "📝 Введите вашу фамилию и имя:",
-        "financing_type": "💵 Какой вид финансирования вы хотите?",
-        "amount": "💰 Сколько вы хотите?",
-        "applicant_type": "👤 На физическое лицо или на фирму хотите?",
-        "collateral_type": "🏠 В залог что хотите предоставить?",
-        "collateral_house": "🏡 Введите информацию о недвижимости (адрес, площадь, стоимость):",
-        "collateral_car": "🚗 Введите информацию о транспортном средстве (марка, модель, год, стоимость):",
-        "phone": "📱 Введите ваш телефонный номер или нажмите кнопку 'Отправить номер':",
-        "phone_button": "📱 Отправить номер",
-        "finish": f"✅ Данная услуга бесплатно, сотрудник банка свяжется с Вами в ближайшее время для консультации, спасибо Вам! {BOT_USERNAME}",
-        "large_amount": "💼 Для кредитов свыше 10 млрд сум: С Вами лично свяжется руководитель по корпоративному кредитованию.",
-        "contact_shared": "✅ Ваш номер телефона принят!",
-        "admin_panel": "⚙️ Админ панель",
-        "applications": "📄 Все заявки",
-        "back": "🔙 Назад",
-        "fin_types": {
-            "fin_1": "🕌 Исламское финансирование от 300 000,0 Долл США",
-            "fin_2": "💵 Кредит наличными до 300 млн сум",
-            "fin_3": "🏦 Кредит свыше 300 млн сум"
-        },
-        "amount_types": {
-            "amt_1": "💵 Кредит наличными до 300 млн сумм",
-            "amt_3": "🏢 Кредит на пополнение оборотных средств, или на приобретение основных средств до 10 млрд сумм",
-            "amt_4": "🕌 Исламское финансирование от 300 000,0 Долл США",
-            "amt_5": "🏦 Финансирование свыше 10 млрд сумм на разные цели"
-        },
-        "app_types": {
-            "app_1": "👤 На Себя как физ лицо",
-            "app_2": "📝 На Патент, у меня частное предпринимательство",
-            "app_3": "🏢 На фирму хочу"
-        },
-        "col_types": {
-            "col_1": "🏠 Недвижимость",
-            "col_2": "🚗 Транспортные средства"
-        }
-    }
-}
+# UI strings live in locales/<lang>.json. A language is loaded the first
+# time somebody needs it, and its keyboards are built right then.
+DEFAULT_LANGUAGE = "uz"
+TEXTS = Catalog(
+    LOCALES_DIR,
+    default=DEFAULT_LANGUAGE,
+    params={"bot_username": BOT_USERNAME},
+    on_load=lambda lang: prebuild_keyboards(lang)
+)
 
 # Keyboards
+# Markups only depend on the language and a static option set, so each one is
+# built once, frozen (see keyboards.py) and shared by every update.
+OPTION_GROUPS = ("fin_types", "amount_types", "app_types", "col_types")
+
+# Amount options offered for each financing type
+AMOUNT_OPTIONS = {
+    "fin_1": ("amt_4",),  # Only show Islamic financing amount for fin_1
+    "fin_2": ("amt_1", "amt_2"),  # Only show cash credit amounts for fin_2
+    "fin_3": ("amt_3", "amt_5"),  # Only show large amounts for fin_3
+}
+
+@lru_cache(maxsize=None)
 def get_language_keyboard():
     kb = InlineKeyboardBuilder()
-    kb.add(
-        InlineKeyboardButton(text="🇺🇿 O'zbekcha", callback_data="lang_uz"),
-        InlineKeyboardButton(text="🇷🇺 Русский", callback_data="lang_ru")
-    )
-    return kb.as_markup()
+    for lang, name in TEXTS.names.items():
+        kb.add(InlineKeyboardButton(text=name, callback_data=f"lang_{lang}"))
+    return freeze(kb.as_markup())
 
+@lru_cache(maxsize=None)
 def get_phone_keyboard(lang: str):
     kb = ReplyKeyboardBuilder()
     kb.add(types.KeyboardButton(
@@ -185,143 +217,295 @@ def get_phone_keyboard(lang: str):
         request_contact=True
     ))
     kb.adjust(1)
-    return kb.as_markup(resize_keyboard=True)
+    return freeze(kb.as_markup(resize_keyboard=True))
 
-def get_options_keyboard(options: dict, lang: str, include_back=True):
+# `keys` limits the keyboard to a subset of the group's options
+@lru_cache(maxsize=None)
+def get_options_keyboard(group: str, lang: str, keys: tuple = None, include_back=True):
     kb = InlineKeyboardBuilder()
-    for key, text in options.items():
-        kb.add(InlineKeyboardButton(text=text, callback_data=key))
+    for key, text in TEXTS[lang][group].items():
+        if keys is None or key in keys:
+            kb.add(InlineKeyboardButton(text=text, callback_data=key))
     if include_back:
         kb.add(InlineKeyboardButton(text=TEXTS[lang]["back"], callback_data="back"))
     kb.adjust(1)
-    return kb.as_markup()
+    return freeze(kb.as_markup())
+
+# For all financing types, show both options and manual input
+@lru_cache(maxsize=None)
+def get_amount_keyboard(lang: str, financing_type: str):
+    kb = InlineKeyboardBuilder()
+    
+    # Add predefined amount options
+    options = AMOUNT_OPTIONS.get(financing_type)
+    for key, text in TEXTS[lang]["amount_types"].items():
+        if options is None or key in options:
+            kb.add(InlineKeyboardButton(text=text, callback_data=key))
+    
+    # Add manual input option
+    kb.add(InlineKeyboardButton(
+        text=TEXTS[lang]["enter_amount_manually"],
+        callback_data="enter_amount"
+    ))
+    
+    # Add back button
+    kb.add(InlineKeyboardButton(
+        text=TEXTS[lang]["back"],
+        callback_data="back"
+    ))
+    
+    kb.adjust(1)
+    return freeze(kb.as_markup())
 
+@lru_cache(maxsize=None)
 def get_admin_keyboard(lang: str):
     kb = InlineKeyboardBuilder()
     kb.add(InlineKeyboardButton(text=TEXTS[lang]["applications"], callback_data="admin_applications"))
+    kb.add(InlineKeyboardButton(text=TEXTS[lang]["statistics"], callback_data="admin_stats"))
     kb.adjust(1)
-    return kb.as_markup()
+    return freeze(kb.as_markup())
 
+@lru_cache(maxsize=None)
 def get_back_keyboard(lang: str):
     kb = InlineKeyboardBuilder()
     kb.add(InlineKeyboardButton(text=TEXTS[lang]["back"], callback_data="admin_back"))
+    return freeze(kb.as_markup())
+
+def prebuild_keyboards(lang: str):
+    get_phone_keyboard(lang)
+    get_admin_keyboard(lang)
+    get_back_keyboard(lang)
+    for group in OPTION_GROUPS:
+        get_options_keyboard(group, lang)
+    get_options_keyboard("app_types", lang, ("app_3",))
+    for financing_type in TEXTS[lang]["fin_types"]:
+        get_amount_keyboard(lang, financing_type)
+
+def get_applications_keyboard(lang: str, newer_key=None, older_key=None):
+    kb = InlineKeyboardBuilder()
+    nav = []
+    if newer_key:
+        nav.append(InlineKeyboardButton(
+            text=TEXTS[lang]["prev_page"],
+            callback_data=f"apps:newer:{newer_key[1]}:{newer_key[0]}"
+        ))
+    if older_key:
+        nav.append(InlineKeyboardButton(
+            text=TEXTS[lang]["next_page"],
+            callback_data=f"apps:older:{older_key[1]}:{older_key[0]}"
+        ))
+    if nav:
+        kb.row(*nav)
+    kb.row(InlineKeyboardButton(text=TEXTS[lang]["back"], callback_data="admin_back"))
     return kb.as_markup()
 
 # Handlers
 @dp.message(Command("start"))
 async def cmd_start(message: Message, state: FSMContext):
-    cursor.execute("SELECT language FROM users WHERE user_id = ?", (message.from_user.id,))
-    user = cursor.fetchone()
+    lang = await db.get_language(message.from_user.id)
     
-    if user:
-        lang = user[0]
+    if lang:
         if message.from_user.id == ADMIN_ID:
-            await message.answer(TEXTS[lang]["admin_panel"], reply_markup=get_admin_keyboard(lang))
+            outbox.submit(message.answer(TEXTS[lang]["admin_panel"], reply_markup=get_admin_keyboard(lang)))
             return
         
-        await message.answer(TEXTS[lang]["full_name"], reply_markup=ReplyKeyboardRemove())
+        outbox.submit(message.answer(TEXTS[lang]["full_name"], reply_markup=ReplyKeyboardRemove()))
         await state.set_state(Form.full_name)
     else:
         # Store username when user first starts the bot
-        cursor.execute(
-            "INSERT INTO users (user_id, username, language) VALUES (?, ?, ?)",
-            (message.from_user.id, message.from_user.username, 'uz')
-        )
-        conn.commit()
-        await message.answer(TEXTS["uz"]["welcome"], reply_markup=get_language_keyboard())
+        await db.add_user(message.from_user.id, message.from_user.username, DEFAULT_LANGUAGE)
+        outbox.submit(message.answer(TEXTS[DEFAULT_LANGUAGE]["welcome"], reply_markup=get_language_keyboard()))
         await state.set_state(Form.language)
 
+@dp.message(Command("export"))
+async def cmd_export(message: Message, command: CommandObject):
+    if message.from_user.id != ADMIN_ID:
+        outbox.submit(message.answer(TEXTS[DEFAULT_LANGUAGE]["no_access"]))
+        return
+    
+    lang = await db.get_language(message.from_user.id) or DEFAULT_LANGUAGE
+    
+    try:
+        fmt, filters = parse_export_args(command.args)
+    except ValueError as e:
+        outbox.submit(message.answer(TEXTS[lang]["export_error"].format(error=html.escape(str(e)))))
+        return
+    
+    # Make sure the latest applications are on disk before reading them
+    await db.flush()
+    file, count = await export_applications(DB_PATH, filters, fmt, labels=TEXTS[lang])
+    
+    if not count:
+        file.close()
+        outbox.submit(message.answer(TEXTS[lang]["no_applications"]))
+        return
+    
+    sent = outbox.submit(message.answer_document(
+        SpooledInputFile(file, f"applications.{fmt}"),
+        caption=f"📄 {count}"
+    ))
+    sent.add_done_callback(lambda _: file.close())
+
+# "/broadcast <uz text> || <ru text>", one text for everybody without "||"
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        outbox.submit(message.answer(TEXTS[DEFAULT_LANGUAGE]["no_access"]))
+        return
+    
+    # html_text keeps the admin's formatting and escapes everything else
+    parts = message.html_text.split(None, 1)
+    if len(parts) < 2:
+        outbox.submit(message.answer(TEXTS[DEFAULT_LANGUAGE]["broadcast_usage"]))
+        return
+    
+    text_uz, _, text_ru = parts[1].partition("||")
+    texts = {"uz": text_uz.strip(), "ru": text_ru.strip() or text_uz.strip()}
+    broadcast_id = await broadcaster.start(texts, message.from_user.id)
+    outbox.submit(message.answer(f"📣 #{broadcast_id} ▶️"))
+
+# "/profile [seconds] [updates]" samples this process's live traffic (see
+# profiler.py). With worker processes it profiles the admin's worker; the
+# others are profiled with `kill -USR1 <pid>`.
+@dp.message(Command("profile"))
+async def cmd_profile(message: Message, command: CommandObject):
+    if message.from_user.id != ADMIN_ID:
+        outbox.submit(message.answer(TEXTS[DEFAULT_LANGUAGE]["no_access"]))
+        return
+    
+    args = (command.args or "").split()
+    try:
+        seconds = float(args[0]) if args else PROFILE_SECONDS
+        updates = int(args[1]) if len(args) > 1 else None
+    except ValueError:
+        outbox.submit(message.answer("⏱ /profile [seconds] [updates]"))
+        return
+    
+    if profiler.start(seconds, updates, on_done=report_profile):
+        outbox.submit(message.answer(f"⏱ ▶️ {seconds:g}s" + (f", {updates} updates" if updates else "")))
+    else:
+        outbox.submit(message.answer("⏱ ⏳"))
+
+# Tells the admin where the profile is and which handlers took the samples
+def report_profile(path, summary):
+    busy = sum(summary["roots"].values()) or 1
+    lines = [f"⏱ {html.escape(path)}", f"{summary['samples']} samples, {summary['idle']} idle"]
+    for root, count in list(summary["roots"].items())[:10]:
+        lines.append(f"{html.escape(root)}: {count * 100 / busy:.0f}%")
+    admin_digest.add("\n".join(lines), urgent=True)
+
+@dp.message(Command("find"))
+async def cmd_find(message: Message, command: CommandObject, state: FSMContext):
+    if message.from_user.id != ADMIN_ID:
+        outbox.submit(message.answer(TEXTS[DEFAULT_LANGUAGE]["no_access"]))
+        return
+    
+    lang = await db.get_language(message.from_user.id) or DEFAULT_LANGUAGE
+    
+    if not command.args:
+        outbox.submit(message.answer(TEXTS[lang]["find_usage"]))
+        return
+    
+    # Kept in the admin's FSM data so the page buttons only carry an offset
+    await state.update_data(find_query=command.args)
+    text, markup = await render_search_page(lang, command.args, 0)
+    outbox.submit(message.answer(text, reply_markup=markup))
+
+@dp.callback_query(F.data.startswith("find:"))
+async def admin_find_page(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID:
+        answer_callback(callback, TEXTS[DEFAULT_LANGUAGE]["no_access"], show_alert=True)
+        return
+    
+    lang = await db.get_language(callback.from_user.id) or DEFAULT_LANGUAGE
+    data = await state.get_data()
+    offset = max(0, int(callback.data.split(":", 1)[1]))
+    
+    text, markup = await render_search_page(lang, data.get("find_query", ""), offset)
+    outbox.submit(callback.message.edit_text(text, reply_markup=markup))
+    answer_callback(callback)
+
+async def render_search_page(lang: str, query: str, offset: int):
+    results = await db.search_applications(query, ADMIN_PAGE_SIZE + 1, offset)
+    
+    if not results:
+        return TEXTS[lang]["nothing_found"], get_back_keyboard(lang)
+    
+    text = f"🔎 {html.escape(query)}\n\n"
+    for app_id, full_name, username, phone, financing_type, amount, status, created_at in results[:ADMIN_PAGE_SIZE]:
+        text += TEXTS[lang]["search_entry"].format(
+            id=app_id,
+            full_name=html.escape(full_name or ''),
+            username=f"@{username}" if username else TEXTS[lang]["no_username"],
+            phone=phone,
+            financing=TEXTS[lang]['fin_types'].get(financing_type, financing_type),
+            created_at=created_at
+        )
+    
+    kb = InlineKeyboardBuilder()
+    nav = []
+    if offset:
+        nav.append(InlineKeyboardButton(
+            text=TEXTS[lang]["prev_page"],
+            callback_data=f"find:{max(0, offset - ADMIN_PAGE_SIZE)}"
+        ))
+    if len(results) > ADMIN_PAGE_SIZE:
+        nav.append(InlineKeyboardButton(
+            text=TEXTS[lang]["next_page"],
+            callback_data=f"find:{offset + ADMIN_PAGE_SIZE}"
+        ))
+    if nav:
+        kb.row(*nav)
+    kb.row(InlineKeyboardButton(text=TEXTS[lang]["back"], callback_data="admin_back"))
+    return text[:MESSAGE_LIMIT], kb.as_markup()
+
 @dp.callback_query(F.data.startswith("lang_"))
 async def process_language(callback: CallbackQuery, state: FSMContext):
     lang = callback.data.split("_")[1]
     
     # Update username when setting language
-    cursor.execute(
-        "INSERT OR IGNORE INTO users (user_id, username, language) VALUES (?, ?, ?)",
-        (callback.from_user.id, callback.from_user.username, lang)
-    )
-    cursor.execute(
-        "UPDATE users SET username = ?, language = ? WHERE user_id = ?",
-        (callback.from_user.username, lang, callback.from_user.id)
-    )
-    conn.commit()
+    await db.upsert_user(callback.from_user.id, callback.from_user.username, lang)
     
-    await callback.message.edit_text(TEXTS[lang]["full_name"])
+    outbox.submit(callback.message.edit_text(TEXTS[lang]["full_name"]))
     await state.set_state(Form.full_name)
-    await callback.answer()
+    answer_callback(callback)
 
 @dp.message(Form.full_name)
 async def process_full_name(message: Message, state: FSMContext):
-    cursor.execute("SELECT language FROM users WHERE user_id = ?", (message.from_user.id,))
-    lang = cursor.fetchone()[0]
+    lang = await db.get_language(message.from_user.id)
     
-    cursor.execute(
-        "UPDATE users SET full_name = ? WHERE user_id = ?",
-        (message.text, message.from_user.id)
-    )
-    conn.commit()
+    await db.set_full_name(message.from_user.id, message.text)
     
-    await message.answer(
+    outbox.submit(message.answer(
         TEXTS[lang]["financing_type"],
-        reply_markup=get_options_keyboard(TEXTS[lang]["fin_types"], lang)
-    )
+        reply_markup=get_options_keyboard("fin_types", lang)
+    ))
     await state.set_state(Form.financing_type)
 
 @dp.callback_query(Form.financing_type, F.data == "back")
 async def back_from_financing_type(callback: CallbackQuery, state: FSMContext):
-    cursor.execute("SELECT language FROM users WHERE user_id = ?", (callback.from_user.id,))
-    lang = cursor.fetchone()[0]
+    lang = await db.get_language(callback.from_user.id)
     
-    await callback.message.edit_text(TEXTS[lang]["full_name"])
+    outbox.submit(callback.message.edit_text(TEXTS[lang]["full_name"]))
     await state.set_state(Form.full_name)
-    await callback.answer()
+    answer_callback(callback)
 
 @dp.callback_query(Form.financing_type)
 async def process_financing_type(callback: CallbackQuery, state: FSMContext):
-    cursor.execute("SELECT language FROM users WHERE user_id = ?", (callback.from_user.id,))
-    lang = cursor.fetchone()[0]
+    lang = await db.get_language(callback.from_user.id)
     
     await state.update_data(financing_type=callback.data)
     
-    # For all financing types, show both options and manual input
-    kb = InlineKeyboardBuilder()
-    
-    # Add predefined amount options
-    for key, text in TEXTS[lang]["amount_types"].items():
-        if callback.data == "fin_1" and key != "amt_4":
-            continue  # Only show Islamic financing amount for fin_1
-        if callback.data == "fin_2" and key not in ["amt_1", "amt_2"]:
-            continue  # Only show cash credit amounts for fin_2
-        if callback.data == "fin_3" and key not in ["amt_3", "amt_5"]:
-            continue  # Only show large amounts for fin_3
-            
-        kb.add(InlineKeyboardButton(text=text, callback_data=key))
-    
-    # Add manual input option
-    kb.add(InlineKeyboardButton(
-        text="Ввести сумму вручную" if lang == "ru" else "Summani qo'lda kiriting",
-        callback_data="enter_amount"
-    ))
-    
-    # Add back button
-    kb.add(InlineKeyboardButton(
-        text=TEXTS[lang]["back"],
-        callback_data="back"
-    ))
-    
-    kb.adjust(1)
-    
-    await callback.message.edit_text(
+    outbox.submit(callback.message.edit_text(
         TEXTS[lang]["amount"],
-        reply_markup=kb.as_markup()
-    )
+        reply_markup=get_amount_keyboard(lang, callback.data)
+    ))
     await state.set_state(Form.amount)
-    await callback.answer()
+    answer_callback(callback)
 
 @dp.callback_query(Form.amount, F.data == "enter_amount")
 async def enter_amount_manually(callback: CallbackQuery, state: FSMContext):
-    cursor.execute("SELECT language FROM users WHERE user_id = ?", (callback.from_user.id,))
-    lang = cursor.fetchone()[0]
+    lang = await db.get_language(callback.from_user.id)
     
     data = await state.get_data()
     financing_type = data.get('financing_type', '')
@@ -329,29 +513,20 @@ async def enter_amount_manually(callback: CallbackQuery, state: FSMContext):
     # Set different minimum amounts based on financing type
     if financing_type == "fin_1":
         min_amount = 300000
-        instruction = ("Введите сумму в долларах США (минимум 300,000):" 
-                      if lang == "ru" 
-                      else "AQSh dollarida summani kiriting (kamida 300,000):")
     elif financing_type == "fin_2":
         min_amount = 1
-        instruction = ("Введите сумму в сумах или долларах:" 
-                      if lang == "ru" 
-                      else "So'm yoki dollar miqdorini kiriting:")
     else:  # fin_3
+        financing_type = "fin_3"
         min_amount = 300000000
-        instruction = ("Введите сумму в сумах (минимум 300 млн):" 
-                      if lang == "ru" 
-                      else "So'mda summani kiriting (kamida 300 mln):")
     
     await state.update_data(min_amount=min_amount)
-    await callback.message.edit_text(instruction)
+    outbox.submit(callback.message.edit_text(TEXTS[lang]["amount_instructions"][financing_type]))
     await state.set_state(Form.amount_input)
-    await callback.answer()
+    answer_callback(callback)
 
 @dp.message(Form.amount_input)
 async def process_amount_input(message: Message, state: FSMContext):
-    cursor.execute("SELECT language FROM users WHERE user_id = ?", (message.from_user.id,))
-    lang = cursor.fetchone()[0]
+    lang = await db.get_language(message.from_user.id)
     
     data = await state.get_data()
     min_amount = data.get('min_amount', 0)
@@ -362,120 +537,107 @@ async def process_amount_input(message: Message, state: FSMContext):
         amount = float(message.text.replace(",", "."))
         
         # Validate based on financing type
-        if financing_type == "fin_1" and amount < 300000:
-            error_msg = ("❌ Минимальная сумма для исламского финансирования - 300,000 USD. Пожалуйста, введите корректную сумму:" 
-                        if lang == "ru" 
-                        else "❌ Islomiy moliyalashtirish uchun minimal summa 300,000 AQSh dollar. Iltimos, to'g'ri summani kiriting:")
-        elif financing_type == "fin_2" and amount <= 0:
-            error_msg = ("❌ Сумма должна быть больше 0. Пожалуйста, введите корректную сумму:" 
-                        if lang == "ru" 
-                        else "❌ Summa 0 dan katta bo'lishi kerak. Iltimos, to'g'ri summani kiriting:")
-        elif financing_type == "fin_3" and amount < 300000000:
-            error_msg = ("❌ Минимальная сумма для этого типа кредита - 300 млн сум. Пожалуйста, введите корректную сумму:" 
-                        if lang == "ru" 
-                        else "❌ Ushbu turdagi kredit uchun minimal summa 300 mln so'm. Iltimos, to'g'ri summani kiriting:")
+        if (
+            (financing_type == "fin_1" and amount < 300000)
+            or (financing_type == "fin_2" and amount <= 0)
+            or (financing_type == "fin_3" and amount < 300000000)
+        ):
+            error_msg = TEXTS[lang]["amount_errors"][financing_type]
         else:
             # Amount is valid
-            await state.update_data(amount=f"{amount}")
+            amount_value, currency, amount_bucket = normalize_amount(financing_type, amount)
+            await state.update_data(
+                amount=f"{amount}",
+                amount_value=amount_value,
+                currency=currency,
+                amount_bucket=amount_bucket
+            )
             
             # Determine which applicant types to show
             if financing_type in ["fin_1", "fin_3"] or amount >= 10000000000:  # 10 billion
-                filtered_app_types = {
-                    "app_3": TEXTS[lang]["app_types"]["app_3"]
-                }
+                app_types = ("app_3",)
             else:
-                filtered_app_types = TEXTS[lang]["app_types"]
+                app_types = None
             
-            await message.answer(
+            outbox.submit(message.answer(
                 TEXTS[lang]["applicant_type"],
-                reply_markup=get_options_keyboard(filtered_app_types, lang)
-            )
+                reply_markup=get_options_keyboard("app_types", lang, app_types)
+            ))
             await state.set_state(Form.applicant_type)
             return
         
-        await message.answer(error_msg)
+        outbox.submit(message.answer(error_msg))
         return
         
     except ValueError:
-        error_msg = ("❌ Пожалуйста, введите числовое значение (например: 300000 или 350000.50):" 
-                    if lang == "ru" 
-                    else "❌ Iltimos, raqamli qiymat kiriting (masalan: 300000 yoki 350000.50):")
-        await message.answer(error_msg)
+        outbox.submit(message.answer(TEXTS[lang]["amount_not_number"]))
 
 @dp.callback_query(Form.amount, F.data == "back")
 async def back_from_amount(callback: CallbackQuery, state: FSMContext):
-    cursor.execute("SELECT language FROM users WHERE user_id = ?", (callback.from_user.id,))
-    lang = cursor.fetchone()[0]
+    lang = await db.get_language(callback.from_user.id)
     
-    await callback.message.edit_text(
+    outbox.submit(callback.message.edit_text(
         TEXTS[lang]["financing_type"],
-        reply_markup=get_options_keyboard(TEXTS[lang]["fin_types"], lang)
-    )
+        reply_markup=get_options_keyboard("fin_types", lang)
+    ))
     await state.set_state(Form.financing_type)
-    await callback.answer()
+    answer_callback(callback)
 
 @dp.callback_query(Form.amount)
 async def process_amount(callback: CallbackQuery, state: FSMContext):
-    cursor.execute("SELECT language FROM users WHERE user_id = ?", (callback.from_user.id,))
-    lang = cursor.fetchone()[0]
-    
-    await state.update_data(amount=callback.data)
+    lang = await db.get_language(callback.from_user.id)
     
     data = await state.get_data()
     financing_type = data.get('financing_type', '')
     
+    amount_value, currency, amount_bucket = normalize_amount(financing_type, callback.data)
+    await state.update_data(
+        amount=callback.data,
+        amount_value=amount_value,
+        currency=currency,
+        amount_bucket=amount_bucket
+    )
+    
     # For Islamic financing or large amounts, only show "For firm" option
     if financing_type == "fin_1" or callback.data in ["amt_3", "amt_5", "fin_3"]:
-        kb = InlineKeyboardBuilder()
-        kb.add(InlineKeyboardButton(
-            text=TEXTS[lang]["app_types"]["app_3"],
-            callback_data="app_3"
-        ))
-        kb.add(InlineKeyboardButton(
-            text=TEXTS[lang]["back"],
-            callback_data="back"
-        ))
-        await callback.message.edit_text(
+        outbox.submit(callback.message.edit_text(
             TEXTS[lang]["applicant_type"],
-            reply_markup=kb.as_markup()
-        )
+            reply_markup=get_options_keyboard("app_types", lang, ("app_3",))
+        ))
     else:
-        await callback.message.edit_text(
+        outbox.submit(callback.message.edit_text(
             TEXTS[lang]["applicant_type"],
-            reply_markup=get_options_keyboard(TEXTS[lang]["app_types"], lang)
-        )
+            reply_markup=get_options_keyboard("app_types", lang)
+        ))
     await state.set_state(Form.applicant_type)
-    await callback.answer()
+    answer_callback(callback)
 
 @dp.callback_query(Form.applicant_type, F.data == "back")
 async def back_from_applicant_type(callback: CallbackQuery, state: FSMContext):
-    cursor.execute("SELECT language FROM users WHERE user_id = ?", (callback.from_user.id,))
-    lang = cursor.fetchone()[0]
+    lang = await db.get_language(callback.from_user.id)
     
-    await callback.message.edit_text(
+    outbox.submit(callback.message.edit_text(
         TEXTS[lang]["amount"],
-        reply_markup=get_options_keyboard(TEXTS[lang]["amount_types"], lang)
-    )
+        reply_markup=get_options_keyboard("amount_types", lang)
+    ))
     await state.set_state(Form.amount)
-    await callback.answer()
+    answer_callback(callback)
 
 @dp.callback_query(Form.applicant_type)
 async def process_applicant_type(callback: CallbackQuery, state: FSMContext):
-    cursor.execute("SELECT language FROM users WHERE user_id = ?", (callback.from_user.id,))
-    lang = cursor.fetchone()[0]
+    lang = await db.get_language(callback.from_user.id)
     
     await state.update_data(applicant_type=callback.data)
-    await callback.message.edit_text(
+    outbox.submit(callback.message.edit_text(
         TEXTS[lang]["collateral_type"],
-        reply_markup=get_options_keyboard(TEXTS[lang]["col_types"], lang)
-    )
+        reply_markup=get_options_keyboard("col_types", lang)
+    ))
     await state.set_state(Form.collateral_type)
-    await callback.answer()
+    answer_callback(callback)
 
 @dp.callback_query(Form.collateral_type, F.data == "back")
 async def back_from_collateral_type(callback: CallbackQuery, state: FSMContext):
-    cursor.execute("SELECT language FROM users WHERE user_id = ?", (callback.from_user.id,))
-    lang = cursor.fetchone()[0]
+    lang = await db.get_language(callback.from_user.id)
     
     # Get current data to determine if we need to show limited options
     data = await state.get_data()
@@ -485,169 +647,201 @@ async def back_from_collateral_type(callback: CallbackQuery, state: FSMContext):
     special_cases = ["fin_1", "fin_3", "amt_3", "amt_5"]
     
     if financing_type in special_cases or amount in special_cases:
-        filtered_app_types = {
-            "app_3": TEXTS[lang]["app_types"]["app_3"]
-        }
+        app_types = ("app_3",)
     else:
-        filtered_app_types = TEXTS[lang]["app_types"]
+        app_types = None
     
-    await callback.message.edit_text(
+    outbox.submit(callback.message.edit_text(
         TEXTS[lang]["applicant_type"],
-        reply_markup=get_options_keyboard(filtered_app_types, lang)
-    )
+        reply_markup=get_options_keyboard("app_types", lang, app_types)
+    ))
     await state.set_state(Form.applicant_type)
-    await callback.answer()
+    answer_callback(callback)
 
 @dp.callback_query(Form.collateral_type)
 async def process_collateral_type(callback: CallbackQuery, state: FSMContext):
-    cursor.execute("SELECT language FROM users WHERE user_id = ?", (callback.from_user.id,))
-    lang = cursor.fetchone()[0]
+    lang = await db.get_language(callback.from_user.id)
     
     collateral_type = callback.data
     await state.update_data(collateral_type=collateral_type)
     
-    if collateral_type == "col_1":
-        await callback.message.answer(TEXTS[lang]["collateral_house"])
-    else:
-        await callback.message.answer(TEXTS[lang]["collateral_car"])
+    prompt = TEXTS[lang]["collateral_house"] if collateral_type == "col_1" else TEXTS[lang]["collateral_car"]
+    # In place: the options are no longer valid once one is chosen
+    outbox.submit(callback.message.edit_text(f"{prompt}\n{TEXTS[lang]['collateral_files']}"))
     
     await state.set_state(Form.collateral_details)
-    await callback.answer()
+    answer_callback(callback)
 
-@dp.message(Form.collateral_details, F.text == TEXTS["uz"]["back"] or F.text == TEXTS["ru"]["back"])
+# The texts of the languages loaded so far, a user's own is always among them
+@dp.message(Form.collateral_details, F.text.func(lambda text: text in TEXTS.loaded_values("back")))
 async def back_from_collateral_details(message: Message, state: FSMContext):
-    cursor.execute("SELECT language FROM users WHERE user_id = ?", (message.from_user.id,))
-    lang = cursor.fetchone()[0]
+    lang = await db.get_language(message.from_user.id)
     
-    await message.answer(
+    outbox.submit(message.answer(
         TEXTS[lang]["collateral_type"],
-        reply_markup=get_options_keyboard(TEXTS[lang]["col_types"], lang)
-    )
+        reply_markup=get_options_keyboard("col_types", lang)
+    ))
     await state.set_state(Form.collateral_type)
 
+# Photos and documents of the collateral. Album items after the caption may
+# arrive once the form already asks for the phone, so they are taken there too.
+@dp.message(StateFilter(Form.collateral_details, Form.phone), F.photo | F.document)
+async def process_collateral_file(message: Message, state: FSMContext, raw_state: str):
+    lang = await db.get_language(message.from_user.id)
+    
+    if message.photo:
+        file, kind, mime_type = message.photo[-1], "photo", "image/jpeg"
+    else:
+        file, kind, mime_type = message.document, "document", message.document.mime_type
+    file_store.intake(file.file_id, file.file_unique_id, kind, mime_type)
+    
+    data = await state.get_data()
+    files = data.get("collateral_files", [])
+    if file.file_unique_id not in files:
+        files = files + [file.file_unique_id]
+        await state.update_data(collateral_files=files)
+    
+    if raw_state != Form.collateral_details.state:
+        return
+    if message.caption:
+        # The caption is the description
+        await state.update_data(collateral_details=message.caption)
+        outbox.submit(message.answer(
+            TEXTS[lang]["phone"],
+            reply_markup=get_phone_keyboard(lang)
+        ))
+        await state.set_state(Form.phone)
+    elif len(files) == 1:
+        # Once per form, not for every photo of an album
+        outbox.submit(message.answer(TEXTS[lang]["file_received"]))
+
 @dp.message(Form.collateral_details)
 async def process_collateral_details(message: Message, state: FSMContext):
-    cursor.execute("SELECT language FROM users WHERE user_id = ?", (message.from_user.id,))
-    lang = cursor.fetchone()[0]
+    lang = await db.get_language(message.from_user.id)
     
     await state.update_data(collateral_details=message.text)
-    await message.answer(
+    outbox.submit(message.answer(
         TEXTS[lang]["phone"],
         reply_markup=get_phone_keyboard(lang)
-    )
+    ))
     await state.set_state(Form.phone)
 
 @dp.message(Form.phone, F.content_type == ContentType.TEXT)
 async def prevent_manual_phone(message: Message):
-    cursor.execute("SELECT language FROM users WHERE user_id = ?", (message.from_user.id,))
-    lang = cursor.fetchone()[0]
+    lang = await db.get_language(message.from_user.id)
     
     if message.text == TEXTS[lang]["back"]:
-        await message.answer(
+        outbox.submit(message.answer(
             TEXTS[lang]["collateral_type"],
-            reply_markup=get_options_keyboard(TEXTS[lang]["col_types"], lang)
-        )
+            reply_markup=get_options_keyboard("col_types", lang)
+        ))
         await Form.collateral_type.set()
     else:
-        await message.answer(
-            "⚠️ Iltimos, telefon raqamingizni 'Raqamni yuborish' tugmasi orqali yuboring!" if lang == "uz" 
-            else "⚠️ Пожалуйста, отправьте номер телефона с помощью кнопки 'Отправить номер'!",
+        outbox.submit(message.answer(
+            TEXTS[lang]["phone_use_button"],
             reply_markup=get_phone_keyboard(lang)
-        )
+        ))
 
 @dp.message(Form.phone, F.content_type == ContentType.CONTACT)
 async def process_phone(message: Message, state: FSMContext):
-    cursor.execute("SELECT language FROM users WHERE user_id = ?", (message.from_user.id,))
-    lang = cursor.fetchone()[0]
+    lang = await db.get_language(message.from_user.id)
     
     phone = message.contact.phone_number
     
     try:
-        # Update user phone
-        cursor.execute(
-            "UPDATE users SET phone = ? WHERE user_id = ?",
-            (phone, message.from_user.id)
-        )
-        
         # Get all data
         data = await state.get_data()
         
-        # Save application
-        cursor.execute(
-            """INSERT INTO applications 
-            (user_id, financing_type, amount, applicant_type, collateral_type, collateral_details, status)
-            VALUES (?, ?, ?, ?, ?, ?, ?)""",
-            (message.from_user.id, data['financing_type'], data['amount'], 
-             data['applicant_type'], data['collateral_type'], data['collateral_details'], 'pending')
-        )
-        conn.commit()
+        # Save user phone and application
+        app_id = await db.insert_application(message.from_user.id, phone, data)
         
-        # Send confirmation to user
-        await message.answer(TEXTS[lang]["contact_shared"], reply_markup=ReplyKeyboardRemove())
-        await message.answer(TEXTS[lang]["finish"])
+        # Send confirmation to user, merged into one message
+        replies = ReplyPlan(outbox, MESSAGE_LIMIT)
+        replies.add(message.answer(TEXTS[lang]["contact_shared"], reply_markup=ReplyKeyboardRemove()))
+        replies.add(message.answer(TEXTS[lang]["finish"]))
         
-        if data['amount'] in ['amt_5', 'fin_3']:
-            await message.answer(TEXTS[lang]["large_amount"])
+        large_amount = data['amount'] in ['amt_5', 'fin_3']
+        if large_amount:
+            replies.add(message.answer(TEXTS[lang]["large_amount"]))
+        replies.submit()
+        APPLICATIONS.inc()
         
         # Prepare admin notification
-        user_data = cursor.execute(
-            "SELECT full_name, phone, language FROM users WHERE user_id = ?", 
-            (message.from_user.id,)
-        ).fetchone()
+        user_data = await db.get_user(message.from_user.id)
         
-        collateral_type_text = TEXTS[user_data[2]]['col_types'].get(data['collateral_type'], data['collateral_type'])
+        texts = TEXTS[user_data[2]]
         
-        app_text = (
-            "📌 Yangi ariza!\n\n" if user_data[2] == "uz" else "📌 Новая заявка!\n\n"
-            f"👤 Ism: {user_data[0]}\n"
-            f"📞 Tel: {user_data[1]}\n"
-            f"💳 Tur: {TEXTS[user_data[2]]['fin_types'].get(data['financing_type'], data['financing_type'])}\n"
-            f"💰 Summa: {TEXTS[user_data[2]]['amount_types'].get(data['amount'], data['amount'])}\n"
-            f"🏛 Tur: {TEXTS[user_data[2]]['app_types'].get(data['applicant_type'], data['applicant_type'])}\n"
-            f"🏠 Garov turi: {collateral_type_text}\n"
-            f"📝 Garov haqida: {data['collateral_details']}"
+        fields = dict(
+            id=app_id,
+            full_name=escape_truncated(user_data[0] or '', NAME_LIMIT),
+            phone=user_data[1],
+            financing=texts['fin_types'].get(data['financing_type'], data['financing_type']),
+            amount=texts['amount_types'].get(data['amount'], data['amount']),
+            applicant=texts['app_types'].get(data['applicant_type'], data['applicant_type']),
+            collateral_type=texts['col_types'].get(data['collateral_type'], data['collateral_type'])
         )
+        files_text = ""
+        if data.get('collateral_files'):
+            files_text = texts["admin_application_files"].format(count=len(data['collateral_files']))
+        # The details get whatever room the rest of the message leaves
+        room = MESSAGE_LIMIT - len(texts["admin_application"].format(**fields, collateral_details="") + files_text)
+        app_text = texts["admin_application"].format(
+            **fields,
+            collateral_details=escape_truncated(data['collateral_details'] or '', room)
+        ) + files_text
         
-        await bot.send_message(ADMIN_ID, app_text)
+        # High-value applications reach the admin at once, the rest with the next digest
+        urgent = data['amount'] == 'amt_5' or data['financing_type'] == 'fin_3'
+        # Escaped and cut to size above: one broken entry would fail the whole digest
+        admin_digest.add(app_text, urgent=urgent)
         
     except Exception as e:
         logging.error(f"Database error: {e}")
-        await message.answer(
-            "❌ Xatolik yuz berdi! Iltimos, qaytadan urinib ko'ring." if lang == "uz" 
-            else "❌ Произошла ошибка! Пожалуйста, попробуйте снова."
-        )
+        outbox.submit(message.answer(TEXTS[lang]["error_retry"]))
     finally:
         await state.clear()
 
 @dp.callback_query(F.data == "admin_applications")
 async def admin_applications(callback: CallbackQuery):
+    await show_applications_page(callback)
+
+@dp.callback_query(F.data.startswith("apps:"))
+async def admin_applications_page(callback: CallbackQuery):
+    # apps:<older|newer>:<id>:<created_at>
+    _, direction, app_id, created_at = callback.data.split(":", 3)
+    key = (created_at, int(app_id))
+    if direction == "older":
+        await show_applications_page(callback, before=key)
+    else:
+        await show_applications_page(callback, after=key)
+
+async def show_applications_page(callback: CallbackQuery, before=None, after=None):
     if callback.from_user.id != ADMIN_ID:
-        await callback.answer("⚠️ Ruxsat yo'q!", show_alert=True)
+        answer_callback(callback, TEXTS[DEFAULT_LANGUAGE]["no_access"], show_alert=True)
         return
     
-    cursor.execute("SELECT language FROM users WHERE user_id = ?", (callback.from_user.id,))
-    row = cursor.fetchone()
-    lang = row[0] if row else "uz"
+    lang = await db.get_language(callback.from_user.id) or DEFAULT_LANGUAGE
     
-    # Query now includes username
-    cursor.execute("""
-    SELECT a.id, u.full_name, u.username, a.financing_type, a.amount, a.applicant_type, 
-           a.collateral_type, a.collateral_details, a.status, a.created_at 
-    FROM applications a
-    JOIN users u ON a.user_id = u.user_id
-    ORDER BY a.created_at DESC
-    """)
-    applications = cursor.fetchall()
+    # One extra row tells whether there is a page beyond this one
+    applications = await db.list_applications(ADMIN_PAGE_SIZE + 1, before=before, after=after)
+    has_newer = after is not None and len(applications) > ADMIN_PAGE_SIZE
+    has_older = after is None and len(applications) > ADMIN_PAGE_SIZE
+    if after is not None:
+        applications = applications[-ADMIN_PAGE_SIZE:]
+        has_older = True
+    else:
+        applications = applications[:ADMIN_PAGE_SIZE]
+        has_newer = before is not None
     
     if not applications:
-        await callback.message.edit_text(
-            "🙅‍♂️ Hozircha arizalar mavjud emas!" if lang == "uz" 
-            else "🙅‍♂️ Нет доступных заявок!",
+        outbox.submit(callback.message.edit_text(
+            TEXTS[lang]["no_applications"],
             reply_markup=get_back_keyboard(lang)
-        )
+        ))
+        answer_callback(callback)
         return
     
-    apps_text = "📄 Barcha arizalar:\n\n" if lang == "uz" else "📄 Все заявки:\n\n"
+    apps_text = TEXTS[lang]["applications_title"]
     
     for app in applications:
         (app_id, full_name, username, financing_type, amount, applicant_type, 
@@ -660,45 +854,225 @@ async def admin_applications(callback: CallbackQuery):
         applicant_text = TEXTS[lang]["app_types"].get(applicant_type, applicant_type)
         collateral_text = TEXTS[lang]["col_types"].get(collateral_type, collateral_type)
         
-        username_display = f"@{username}" if username else "Yo'q" if lang == "uz" else "Нет"
-        
-        apps_text += (
-            f"🆔 ID: {app_id}\n"
-            f"👤 Ism: {full_name}\n"
-            f"📱 Username: {username_display}\n"
-            f"💳 Tur: {financing_text}\n"
-            f"💰 Summa: {amount_text}\n"
-            f"👥 Arizachi: {applicant_text}\n"
-            f"📅 Sana: {created_at}\n\n"
+        apps_text += TEXTS[lang]["application_entry"].format(
+            id=app_id,
+            full_name=html.escape(full_name or ''),
+            username=f"@{username}" if username else TEXTS[lang]["no_username"],
+            financing=financing_text,
+            amount=amount_text,
+            applicant=applicant_text,
+            created_at=created_at
+        )
+    
+    newest, oldest = applications[0], applications[-1]
+    outbox.submit(callback.message.edit_text(
+        apps_text[:MESSAGE_LIMIT],
+        reply_markup=get_applications_keyboard(
+            lang,
+            newer_key=(newest[9], newest[0]) if has_newer else None,
+            older_key=(oldest[9], oldest[0]) if has_older else None
         )
+    ))
+    answer_callback(callback)
+
+@dp.callback_query(F.data == "admin_stats")
+async def admin_stats(callback: CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        answer_callback(callback, TEXTS[DEFAULT_LANGUAGE]["no_access"], show_alert=True)
+        return
     
-    await callback.message.edit_text(
-        apps_text,
-        reply_markup=get_back_keyboard(lang)
+    lang = await db.get_language(callback.from_user.id) or DEFAULT_LANGUAGE
+    stats = await db.get_application_stats(days=STATS_DAYS)
+    
+    by_status = stats.get("status", {})
+    text = (
+        f"{TEXTS[lang]['statistics']}\n\n"
+        f"{TEXTS[lang]['stats_total'].format(total=sum(by_status.values()))}\n"
+        f"🕒 {by_status.get('pending', 0)}  ✅ {by_status.get('approved', 0)}  ❌ {by_status.get('rejected', 0)}\n\n"
     )
-    await callback.answer()
+    for group, dimension in (("fin_types", "financing_type"), ("app_types", "applicant_type")):
+        for key, count in sorted(stats.get(dimension, {}).items(), key=lambda item: -item[1]):
+            text += f"{TEXTS[lang][group].get(key, key or '—')}: {count}\n"
+        text += "\n"
+    text += TEXTS[lang]["stats_days"].format(days=STATS_DAYS) + "\n"
+    for day, count in sorted(stats.get("day", {}).items(), reverse=True):
+        text += f"{day}: {count}\n"
+    
+    outbox.submit(callback.message.edit_text(text[:MESSAGE_LIMIT], reply_markup=get_back_keyboard(lang)))
+    answer_callback(callback)
 
 @dp.callback_query(F.data == "admin_back")
 async def admin_back(callback: CallbackQuery):
     if callback.from_user.id != ADMIN_ID:
-        await callback.answer("⚠️ Ruxsat yo'q!", show_alert=True)
+        answer_callback(callback, TEXTS[DEFAULT_LANGUAGE]["no_access"], show_alert=True)
         return
     
-    cursor.execute("SELECT language FROM users WHERE user_id = ?", (callback.from_user.id,))
-    row = cursor.fetchone()
-    lang = row[0] if row else "uz"
+    lang = await db.get_language(callback.from_user.id) or DEFAULT_LANGUAGE
     
-    await callback.message.edit_text(
+    outbox.submit(callback.message.edit_text(
         TEXTS[lang]["admin_panel"],
         reply_markup=get_admin_keyboard(lang)
-    )
-    await callback.answer()
+    ))
+    answer_callback(callback)
 
 # Start
+async def health(request: web.Request):
+    return web.Response(text="ok")
+
+async def webhook(request: web.Request):
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not secrets.compare_digest(token, WEBHOOK_SECRET):
+        return web.Response(status=401, text="Unauthorized")
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+    except ValueError:
+        # Not JSON, or not an Update
+        return web.Response(status=400, text="Bad Request")
+    # Answer Telegram at once, the scheduler processes the update
+    await update_sink.submit(update)
+    return web.Response()
+
+def create_web_app():
+    app = web.Application()
+    app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_post(WEBHOOK_PATH, webhook)
+    app.on_shutdown.append(lambda _: update_sink.close())
+    setup_application(app, dp, bot=bot)
+    app.on_cleanup.append(lambda _: bot.session.close())
+    return app
+
+async def run_webhook():
+    await update_sink.restore()
+    runner = web.AppRunner(create_web_app())
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logging.info("Webhook server listening on %s:%s", WEBHOOK_HOST, WEBHOOK_PORT)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+async def run_polling():
+    runner = None
+    if METRICS_PORT:
+        app = web.Application()
+        app.router.add_get("/health", health)
+        app.router.add_get("/metrics", metrics_handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_HOST, METRICS_PORT).start()
+    try:
+        # Keep the updates sent while the bot was down, they are drained below
+        await bot.delete_webhook()
+        await update_sink.restore()
+        await dp.emit_startup(bot=bot, dispatcher=dp)
+        allowed_updates = dp.resolve_used_update_types()
+        try:
+            count, elapsed = await drain_backlog(bot, update_sink, allowed_updates)
+            logging.info("Drained %s pending updates in %.1fs", count, elapsed)
+            if count:
+                admin_digest.add(f"♻️ {count} updates, {elapsed:.1f}s", urgent=True)
+            logging.info("Start polling")
+            await poll_updates(bot, update_sink, allowed_updates=allowed_updates)
+        finally:
+            await update_sink.close()
+            await dp.emit_shutdown(bot=bot, dispatcher=dp)
+            await bot.session.close()
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
 async def main():
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    get_language_keyboard()
+    TEXTS[DEFAULT_LANGUAGE]  # Loads the default language and builds its keyboards
+    # Stop gracefully on SIGTERM from the process manager
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, lambda: profiler.start(PROFILE_SECONDS))
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await run_polling()
+    except asyncio.CancelledError:
+        logging.info("Stopped")
+    finally:
+        log_stats()
+        await db.close()
+
+def log_stats():
+    logging.info("User cache: %s", db.user_cache.stats())
+    logging.info("DB writes: %s", db.write_stats())
+    logging.info("Outbox: %s", outbox.stats())
+    logging.info("Scheduler: %s", scheduler.stats())
+    if supervisor is not None:
+        logging.info("Workers: %s", supervisor.stats())
+    logging.info("Broadcasts: %s", broadcaster.stats())
+    logging.info("Admin digest: %s", admin_digest.stats())
+    logging.info("Archive: %s", archiver.stats())
+    logging.info("Files: %s", file_store.stats())
+    logging.info("Profiler: %s", profiler.stats())
+
+# Worker process in supervisor mode. This module was imported again with
+# WORKER_INDEX set, so everything above is the worker's own.
+def run_worker(index, updates, stats, write_lock):
+    logging.basicConfig(level=logging.INFO, format=f"[worker {index}] %(levelname)s:%(name)s:%(message)s")
+    # The supervisor stops its workers once they have all their updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(serve_worker(updates, stats, write_lock))
+
+async def serve_worker(updates, stats, write_lock):
+    db.write_lock = write_lock
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, lambda: profiler.start(PROFILE_SECONDS))
+    get_language_keyboard()
+    TEXTS[DEFAULT_LANGUAGE]
+    try:
+        await dp.emit_startup(bot=bot, dispatcher=dp)
+        await serve_shard(updates, stats, scheduler, bot)
+    finally:
+        await scheduler.close()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
+        log_stats()
+        await db.close()
+
+supervisor = Supervisor(run_worker, WORKERS, db, max_pending=UPDATE_MAX_PENDING) if SUPERVISOR else None
+# Where incoming updates go: the worker processes, or this process's scheduler
+update_sink = supervisor or scheduler
+
+if supervisor is not None:
+    REGISTRY.callback(
+        "bot_worker_up", "Whether the worker process is running",
+        lambda: {(str(i),): int(w["alive"]) for i, w in enumerate(supervisor.stats()["workers"])},
+        labels=("worker",)
+    )
+    REGISTRY.callback(
+        "bot_worker_restarts_total", "Worker processes restarted after a crash",
+        lambda: {(str(i),): count for i, count in enumerate(supervisor.restarts)},
+        type="counter", labels=("worker",)
+    )
+    REGISTRY.callback(
+        "bot_worker_dispatched_total", "Updates handed to the worker",
+        lambda: {(str(i),): count for i, count in enumerate(supervisor.dispatched)},
+        type="counter", labels=("worker",)
+    )
+    REGISTRY.callback(
+        "bot_worker_pending", "Updates waiting or running in the worker, as last reported",
+        lambda: {(str(i),): stats.get("pending", 0) for i, stats in enumerate(supervisor.worker_stats)},
+        labels=("worker",)
+    )
+    REGISTRY.callback(
+        "bot_worker_processed_total", "Updates the worker processed, as last reported",
+        lambda: {(str(i),): stats.get("processed", 0) for i, stats in enumerate(supervisor.worker_stats)},
+        type="counter", labels=("worker",)
+    )
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
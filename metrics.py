@@ -0,0 +1,220 @@
+import bisect
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject
+from aiohttp import web
+
+# Preaggregated metrics rendered in the Prometheus text format. Nothing is
+# logged per event: observations only bump counters and histogram buckets.
+#
+# Each metric's values are a dict of label values tuple -> value. render()
+# takes another process's snapshot of them and extra labels (names, values)
+# that tell the processes apart.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, value=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self, values=None, extra=((), ())):
+        names = extra[0] + self.label_names
+        for labels, value in sorted((self._values if values is None else values).items()):
+            yield f"{self.name}{_labels(names, extra[1] + labels)} {value}"
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [bucket counts..., +Inf count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {labels: list(counts) for labels, counts in self._values.items()}
+
+    def render(self, values=None, extra=((), ())):
+        names = extra[0] + self.label_names
+        for labels, counts in sorted((self._values if values is None else values).items()):
+            labels = extra[1] + labels
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = _labels(names + ("le",), labels + (bound,))
+                yield f"{self.name}_bucket{le} {cumulative}"
+            yield f"{self.name}_sum{_labels(names, labels)} {counts[-1]}"
+            yield f"{self.name}_count{_labels(names, labels)} {cumulative}"
+
+
+# Value read from a callback at scrape time, e.g. a queue depth, or a
+# counter kept elsewhere (type="counter"). With labels the callback returns
+# a dict of label values tuple -> value.
+class CallbackMetric:
+    def __init__(self, name, help, fn, type="gauge", labels=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.type = type
+        self.label_names = tuple(labels)
+
+    def snapshot(self):
+        return dict(self.fn()) if self.label_names else {(): self.fn()}
+
+    def render(self, values=None, extra=((), ())):
+        names = extra[0] + self.label_names
+        for labels, value in sorted((self.snapshot() if values is None else values).items()):
+            yield f"{self.name}{_labels(names, extra[1] + labels)} {value}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # Snapshots of other processes' registries: (label names, label values) -> snapshot
+        self.remote = {}
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, fn, type="gauge", labels=()):
+        return self.register(CallbackMetric(name, help, fn, type, labels))
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+            for extra, snapshot in sorted(self.remote.items()):
+                if metric.name in snapshot:
+                    lines.extend(metric.render(snapshot[metric.name], extra))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.histogram(
+    "bot_handler_seconds", "Handler latency", labels=("handler",)
+)
+HANDLER_ERRORS = REGISTRY.counter(
+    "bot_handler_errors_total", "Handlers that raised", labels=("handler",)
+)
+STATE_TRANSITIONS = REGISTRY.counter(
+    "bot_state_transitions_total", "Form state transitions", labels=("from_state", "to_state")
+)
+DB_SECONDS = REGISTRY.histogram(
+    "bot_db_query_seconds", "Time spent in database operations", labels=("query",)
+)
+API_CALLS = REGISTRY.counter(
+    "bot_api_calls_total", "Telegram API calls", labels=("method", "result")
+)
+API_SECONDS = REGISTRY.histogram(
+    "bot_api_call_seconds", "Telegram API call latency", labels=("method",)
+)
+# API calls per application: rate(bot_api_calls_total) / rate(bot_applications_total)
+APPLICATIONS = REGISTRY.counter(
+    "bot_applications_total", "Completed applications"
+)
+SCHEDULER_WAIT_SECONDS = REGISTRY.histogram(
+    "bot_update_wait_seconds", "Time updates wait in the scheduler before a handler runs"
+)
+
+
+# Inner middleware for message/callback_query observers: times the handler
+# that actually ran and counts the FSM transition it made
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        state_before = data.get("raw_state")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+            state = data.get("state")
+            if state is not None:
+                state_after = await state.get_state()
+                if state_after != state_before:
+                    STATE_TRANSITIONS.inc(state_before or "none", state_after or "none")
+
+
+# Session middleware counting every outbound Telegram API call
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            response = await make_request(bot, method)
+        except Exception:
+            API_CALLS.inc(name, "error")
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - started, name)
+        API_CALLS.inc(name, "ok")
+        return response
+
+
+async def metrics_handler(request: web.Request):
+    return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
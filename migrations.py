@@ -0,0 +1,324 @@
+import logging
+import sqlite3
+
+from amounts import normalize_amount
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _initial_schema(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        full_name TEXT,
+        username TEXT,
+        phone TEXT,
+        language TEXT DEFAULT 'uz',
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS applications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        financing_type TEXT,
+        amount TEXT,
+        applicant_type TEXT,
+        collateral_type TEXT,
+        collateral_details TEXT,
+        status TEXT DEFAULT 'pending',
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(user_id)
+    )
+    """)
+    # Databases created before usernames were stored
+    if "username" not in _columns(conn, "users"):
+        conn.execute("ALTER TABLE users ADD COLUMN username TEXT")
+
+
+def _application_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_applications_user_id ON applications(user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_applications_status ON applications(status, created_at)")
+    # Keyset pagination of the admin applications browser
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_applications_created_at_id ON applications(created_at, id)"
+    )
+
+
+# Full-text index over the searchable user and application columns, keyed
+# by application id and kept in sync by triggers
+def _applications_fts(conn):
+    conn.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS applications_fts USING fts5(
+        full_name, username, phone, collateral_details,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """)
+    index_application = """
+        INSERT INTO applications_fts (rowid, full_name, username, phone, collateral_details)
+        SELECT a.id, u.full_name, u.username, u.phone, a.collateral_details
+        FROM applications a LEFT JOIN users u ON u.user_id = a.user_id
+    """
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS applications_fts_insert AFTER INSERT ON applications BEGIN
+        {index_application} WHERE a.id = new.id;
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS applications_fts_update
+    AFTER UPDATE OF user_id, collateral_details ON applications BEGIN
+        DELETE FROM applications_fts WHERE rowid = old.id;
+        {index_application} WHERE a.id = new.id;
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS applications_fts_delete AFTER DELETE ON applications BEGIN
+        DELETE FROM applications_fts WHERE rowid = old.id;
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS users_fts_update
+    AFTER UPDATE OF full_name, username, phone ON users BEGIN
+        DELETE FROM applications_fts
+        WHERE rowid IN (SELECT id FROM applications WHERE user_id = new.user_id);
+        {index_application} WHERE a.user_id = new.user_id;
+    END
+    """)
+    conn.execute("DELETE FROM applications_fts")
+    conn.execute(index_application)
+
+
+# Admin broadcasts with a user_id cursor and per-recipient results, so an
+# interrupted broadcast resumes after the last recorded page
+def _broadcasts(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        texts TEXT NOT NULL,
+        created_by INTEGER,
+        status TEXT DEFAULT 'running',
+        last_user_id INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        finished_at TEXT
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        broadcast_id INTEGER,
+        user_id INTEGER,
+        status TEXT,
+        error TEXT,
+        PRIMARY KEY (broadcast_id, user_id)
+    ) WITHOUT ROWID
+    """)
+
+
+# Application counts per status, financing type, applicant type and day,
+# kept current by triggers so the admin dashboard never scans applications
+STAT_DIMENSIONS = {
+    "status": "{row}.status",
+    "financing_type": "{row}.financing_type",
+    "applicant_type": "{row}.applicant_type",
+    "day": "date({row}.created_at)",
+}
+
+
+# Trigger statement adding `delta` to the counter of `row` ("new" or "old")
+def _bump_stat(dimension, row, delta):
+    value = STAT_DIMENSIONS[dimension].format(row=row)
+    return f"""
+    INSERT INTO application_stats (dimension, value, count)
+    VALUES ('{dimension}', COALESCE({value}, ''), {delta})
+    ON CONFLICT (dimension, value) DO UPDATE SET count = count + {delta};
+    """
+
+
+def _application_stats(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS application_stats (
+        dimension TEXT,
+        value TEXT,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (dimension, value)
+    ) WITHOUT ROWID
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS application_stats_insert AFTER INSERT ON applications BEGIN
+        {"".join(_bump_stat(dimension, "new", 1) for dimension in STAT_DIMENSIONS)}
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS application_stats_update
+    AFTER UPDATE OF status, financing_type, applicant_type, created_at ON applications BEGIN
+        {"".join(_bump_stat(dimension, "old", -1) for dimension in STAT_DIMENSIONS)}
+        {"".join(_bump_stat(dimension, "new", 1) for dimension in STAT_DIMENSIONS)}
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS application_stats_delete AFTER DELETE ON applications BEGIN
+        {"".join(_bump_stat(dimension, "old", -1) for dimension in STAT_DIMENSIONS)}
+    END
+    """)
+    conn.execute("DELETE FROM application_stats")
+    for dimension, value in STAT_DIMENSIONS.items():
+        value = value.format(row="a")
+        conn.execute(f"""
+        INSERT INTO application_stats (dimension, value, count)
+        SELECT '{dimension}', COALESCE({value}, ''), COUNT(*) FROM applications a GROUP BY 2
+        """)
+
+
+# Numeric amount, currency and range bucket next to the free-form amount,
+# so amount filters are index range scans instead of parsing every row
+def _normalized_amounts(conn):
+    columns = _columns(conn, "applications")
+    for column, type in (("amount_value", "REAL"), ("currency", "TEXT"), ("amount_bucket", "TEXT")):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE applications ADD COLUMN {column} {type}")
+    rows = conn.execute("SELECT id, financing_type, amount FROM applications").fetchall()
+    conn.executemany(
+        "UPDATE applications SET amount_value = ?, currency = ?, amount_bucket = ? WHERE id = ?",
+        [(*normalize_amount(financing_type, amount), app_id) for app_id, financing_type, amount in rows]
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_applications_currency_amount ON applications(currency, amount_value)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_applications_amount_bucket ON applications(amount_bucket, created_at)"
+    )
+
+
+# Small key/value settings the bot keeps across restarts, e.g. the offset
+# of the last processed update
+def _bot_state(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS bot_state (
+        key TEXT PRIMARY KEY,
+        value TEXT,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+
+# Cold storage for old and processed applications; the archiver moves rows
+# here in batches to keep the hot table and its indexes small
+def _applications_archive(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS applications_archive (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        financing_type TEXT,
+        amount TEXT,
+        amount_value REAL,
+        currency TEXT,
+        amount_bucket TEXT,
+        applicant_type TEXT,
+        collateral_type TEXT,
+        collateral_details TEXT,
+        status TEXT,
+        created_at TEXT,
+        archived_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_applications_archive_created_at_id "
+        "ON applications_archive(created_at, id)"
+    )
+    # Archiving is not a deletion, the dashboard keeps counting those rows
+    conn.execute("DROP TRIGGER IF EXISTS application_stats_delete")
+    conn.execute(f"""
+    CREATE TRIGGER application_stats_delete AFTER DELETE ON applications
+    WHEN NOT EXISTS (SELECT 1 FROM applications_archive WHERE id = old.id) BEGIN
+        {"".join(_bump_stat(dimension, "old", -1) for dimension in STAT_DIMENSIONS)}
+    END
+    """)
+
+
+# Collateral photos and documents: one row per Telegram file_unique_id
+# pointing at its content hash in the file store, and the files attached
+# to each application
+def _collateral_files(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS files (
+        file_unique_id TEXT PRIMARY KEY,
+        sha256 TEXT NOT NULL,
+        size INTEGER,
+        kind TEXT,
+        mime_type TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_files_sha256 ON files(sha256)")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS application_files (
+        application_id INTEGER,
+        file_unique_id TEXT,
+        PRIMARY KEY (application_id, file_unique_id)
+    ) WITHOUT ROWID
+    """)
+
+
+# (version, description, apply) - append only, never edit an applied migration
+MIGRATIONS = [
+    (1, "initial schema", _initial_schema),
+    (2, "application indexes", _application_indexes),
+    (3, "applications full-text search", _applications_fts),
+    (4, "broadcasts", _broadcasts),
+    (5, "application statistics", _application_stats),
+    (6, "normalized amounts", _normalized_amounts),
+    (7, "bot state", _bot_state),
+    (8, "applications archive", _applications_archive),
+    (9, "collateral files", _collateral_files),
+]
+
+
+def apply_pragmas(conn, cache_size_kib: int = 65536):
+    # WAL lets readers run alongside the writer; NORMAL is durable in WAL mode
+    # except for the last transactions on power loss, and skips most fsyncs
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{int(cache_size_kib)}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA busy_timeout=5000")
+
+
+# auto_vacuum only changes with a VACUUM, which cannot run inside the
+# migrations' transactions; it runs once, then freed pages are returned to
+# the OS with PRAGMA incremental_vacuum
+def enable_incremental_vacuum(conn):
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        logging.info("Enabled incremental vacuum")
+
+
+def migrate(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    conn.commit()
+    current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+    for version, description, apply in MIGRATIONS:
+        if version <= current:
+            continue
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            apply(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description)
+            )
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        logging.info("Applied migration %s: %s", version, description)
@@ -0,0 +1,195 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+
+# Priority lanes, lower is sent first
+USER_REPLY = 0
+NOTIFICATION = 1
+BROADCAST = 2
+
+
+class OutboxFull(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # Seconds until a token is available, 0 if it can be taken now
+    def delay(self) -> float:
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+
+# Outbound API call scheduler. Handlers submit ready-made Telegram methods and
+# return immediately; workers send them under a global and a per-chat token
+# bucket, keep each chat's messages in order and back off on RetryAfter.
+class Outbox:
+    def __init__(
+        self,
+        bot: Bot,
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        chat_burst: float = 5.0,
+        max_queue: int = 10000,
+        workers: int = 8,
+    ):
+        self.bot = bot
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_queue = max_queue
+        self.workers = workers
+        self._global = TokenBucket(global_rate, global_rate)
+        # Per-chat FIFO of (priority, method, future)
+        self._chats = {}
+        self._buckets = {}
+        # Chats with something to send, at most once each: (priority, seq, chat_id)
+        self._ready = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self.depth = 0
+        self.lane_depth = {USER_REPLY: 0, NOTIFICATION: 0, BROADCAST: 0}
+        self.max_depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+
+    def submit(self, method: TelegramMethod, priority: int = USER_REPLY) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(self._log_failure)
+        if self.depth >= self.max_queue:
+            self.dropped += 1
+            future.set_exception(OutboxFull(f"Outbox is full ({self.max_queue} messages)"))
+            return future
+
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+        chat_id = getattr(method, "chat_id", None)
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            queue = self._chats[chat_id] = deque()
+            self._schedule(chat_id, priority)
+        queue.append((priority, method, future))
+        self.depth += 1
+        self.lane_depth[priority] = self.lane_depth.get(priority, 0) + 1
+        self.max_depth = max(self.max_depth, self.depth)
+        return future
+
+    def _log_failure(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f"Outbound message failed: {future.exception()}")
+
+    def _schedule(self, chat_id, priority):
+        heapq.heappush(self._ready, (priority, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    def _reschedule(self, chat_id, delay=0.0):
+        queue = self._chats.get(chat_id)
+        if not queue:
+            self._chats.pop(chat_id, None)
+            return
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._schedule, chat_id, queue[0][0])
+        else:
+            self._schedule(chat_id, queue[0][0])
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            _, _, chat_id = heapq.heappop(self._ready)
+
+            bucket = self._chat_bucket(chat_id)
+            delay = bucket.delay()
+            if delay > 0:
+                # Let other chats go first while this one cools down
+                self._reschedule(chat_id, delay)
+                continue
+            while (delay := self._global.delay()) > 0:
+                await asyncio.sleep(delay)
+            self._global.take()
+            bucket.take()
+
+            priority, method, future = self._chats[chat_id][0]
+            try:
+                result = await self.bot(method)
+            except TelegramRetryAfter as e:
+                self.retried += 1
+                logging.warning(f"Flood limit for chat {chat_id}, retrying in {e.retry_after}s")
+                self._reschedule(chat_id, e.retry_after)
+                continue
+            except Exception as e:
+                self.failed += 1
+                self._pop(chat_id)
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.sent += 1
+                self._pop(chat_id)
+                if not future.done():
+                    future.set_result(result)
+            self._reschedule(chat_id)
+
+            # Drop idle chat buckets once they are full again
+            if len(self._buckets) > self.max_queue:
+                for key in [k for k, b in self._buckets.items() if k not in self._chats and b.delay() == 0]:
+                    del self._buckets[key]
+
+    def _pop(self, chat_id):
+        priority = self._chats[chat_id].popleft()[0]
+        self.depth -= 1
+        self.lane_depth[priority] -= 1
+
+    async def drain(self, timeout: float = 10.0):
+        deadline = time.monotonic() + timeout
+        while self.depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    async def close(self, timeout: float = 10.0):
+        await self.drain(timeout)
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "lane_depth": dict(self.lane_depth),
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from aiogram import Dispatcher, Router
+
+# A thread whose innermost frame is in one of these is waiting, not working
+IDLE_FILES = ("selectors.py", "threading.py", "queue.py", "thread.py")
+# Root of event loop stacks in feed_update but not in a handler: filters,
+# middlewares, FSM storage, parsing the update
+DISPATCH = "dispatch"
+
+
+def _frame_name(code):
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)})"
+
+
+# Code object -> name of every handler registered on the dispatcher, and
+# feed_update's -> DISPATCH
+def handler_codes(dp: Dispatcher):
+    codes = {Dispatcher.feed_update.__code__: DISPATCH}
+    for router in dp.chain_tail:
+        for observer in router.observers.values():
+            for handler in observer.handlers:
+                # Routers register their own methods, e.g. the update observer
+                if isinstance(getattr(handler.callback, "__self__", None), Router):
+                    continue
+                code = getattr(handler.callback, "__code__", None)
+                if code is not None:
+                    codes[code] = handler.callback.__name__
+    return codes
+
+
+# Sampling profiler for live traffic, off until started. A background thread
+# takes the stacks of all threads every `interval` seconds while updates are
+# inside dp.feed_update, for `seconds` or until `updates` updates were fed.
+# Event loop stacks are rooted at the handler they run in (process_phone,
+# admin_applications, ...), other threads' stacks at the thread name (db,
+# fsm, ...), and waiting threads are only counted. The result is written to
+# <directory>/profile-<pid>-<time>.folded in the collapsed stack format
+# flamegraph.pl and speedscope read.
+class SamplingProfiler:
+    def __init__(self, dp: Dispatcher, directory: str, interval: float = 0.005):
+        self.dp = dp
+        self.directory = directory
+        self.interval = interval
+        self._thread = None
+        self._stop = threading.Event()
+        self._inflight = 0  # Updates inside feed_update while profiling
+        self._updates_left = None
+        self.sessions = 0
+        self.last_path = None
+        dp.update.outer_middleware(self._track)
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    async def _track(self, handler, event, data):
+        if self._thread is None:
+            return await handler(event, data)
+        self._inflight += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self._inflight -= 1
+            if self._updates_left is not None:
+                self._updates_left -= 1
+                if self._updates_left <= 0:
+                    self._stop.set()
+
+    # Call on the event loop. on_done(path, summary) is called on the loop
+    # when the profile is saved. Returns False if one is running already.
+    def start(self, seconds: float = 30.0, updates: int = None, on_done=None):
+        if self._thread is not None:
+            return False
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._codes = handler_codes(self.dp)
+        self._updates_left = updates
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(seconds, on_done), name="profiler", daemon=True
+        )
+        self._thread.start()
+        logging.info("Profiling for %ss or %s updates", seconds, updates or "any number of")
+        return True
+
+    def _run(self, seconds, on_done):
+        path = summary = None
+        try:
+            stacks, summary = self._sample(seconds)
+            path = self._save(stacks)
+        except Exception as e:
+            logging.exception(f"Profiling failed: {e}")
+        self._loop.call_soon_threadsafe(self._done, path, summary, on_done)
+
+    def _sample(self, seconds):
+        me = threading.get_ident()
+        stacks = Counter()
+        roots = Counter()
+        samples = idle = 0
+        deadline = time.monotonic() + seconds
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            if not self._inflight:
+                continue
+            samples += 1
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if os.path.basename(frame.f_code.co_filename) in IDLE_FILES:
+                    idle += 1
+                    continue
+                root = "loop" if ident == self._loop_thread else names.get(ident, str(ident))
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    if ident == self._loop_thread and code in self._codes:
+                        # What is above is the same scheduling for every update
+                        root = self._codes[code]
+                        break
+                    stack.append(_frame_name(code))
+                    frame = frame.f_back
+                del frame
+                stack.append(root)
+                stacks[";".join(reversed(stack))] += 1
+                roots[root] += 1
+        summary = {"samples": samples, "idle": idle, "roots": dict(roots.most_common())}
+        return stacks, summary
+
+    def _save(self, stacks):
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+        path = os.path.join(self.directory, name)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+    def _done(self, path, summary, on_done):
+        self._thread = None
+        self._updates_left = None
+        self.sessions += 1
+        self.last_path = path
+        if path is None:
+            return
+        logging.info("Profile saved to %s: %s", path, summary)
+        if on_done is not None:
+            on_done(path, summary)
+
+    async def close(self):
+        thread = self._thread
+        if thread is not None:
+            self._stop.set()
+            await asyncio.to_thread(thread.join)
+
+    def stats(self):
+        return {"running": self.running, "sessions": self.sessions, "last": self.last_path}
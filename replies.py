@@ -0,0 +1,77 @@
+import asyncio
+import logging
+
+from aiogram.methods import SendMessage, TelegramMethod
+from aiogram.types import CallbackQuery
+
+from outbox import USER_REPLY, Outbox
+
+_answers = set()
+
+
+def _mergeable(first, second, limit):
+    return (
+        isinstance(first, SendMessage)
+        and isinstance(second, SendMessage)
+        and first.chat_id == second.chat_id
+        and first.message_thread_id == second.message_thread_id
+        and first.parse_mode == second.parse_mode
+        and first.reply_parameters is None
+        and second.reply_parameters is None
+        and (first.reply_markup is None or second.reply_markup is None)
+        and len(first.text) + 2 + len(second.text) <= limit
+    )
+
+
+# Joins consecutive messages to the same chat into one when at most one of
+# them carries a keyboard and the result fits in a message
+def plan_replies(methods, limit: int = 4096):
+    planned = []
+    for method in methods:
+        if planned and _mergeable(planned[-1], method, limit):
+            last = planned[-1]
+            planned[-1] = last.model_copy(update={
+                "text": f"{last.text}\n\n{method.text}",
+                "reply_markup": last.reply_markup or method.reply_markup,
+            })
+        else:
+            planned.append(method)
+    return planned
+
+
+# The replies of one handler, sent through the outbox in as few API calls
+# as plan_replies can make of them
+class ReplyPlan:
+    def __init__(self, outbox: Outbox, limit: int = 4096):
+        self.outbox = outbox
+        self.limit = limit
+        self.methods = []
+
+    def add(self, method: TelegramMethod):
+        self.methods.append(method)
+        return self
+
+    def submit(self, priority: int = USER_REPLY):
+        methods, self.methods = plan_replies(self.methods, self.limit), []
+        return [self.outbox.submit(method, priority) for method in methods]
+
+
+async def _answer(method):
+    try:
+        await method
+    except Exception as e:
+        logging.warning(f"Failed to answer callback query: {e}")
+
+
+# Answers a callback query alongside the handler's next action instead of
+# holding the handler for the round trip
+def answer_callback(callback: CallbackQuery, text: str = None, show_alert: bool = None):
+    task = asyncio.create_task(_answer(callback.answer(text, show_alert=show_alert)))
+    _answers.add(task)
+    task.add_done_callback(_answers.discard)
+    return task
+
+
+async def wait_answers():
+    if _answers:
+        await asyncio.wait(list(_answers))
@@ -0,0 +1,278 @@
+import asyncio
+import heapq
+import logging
+import time
+from collections import deque
+
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.types import Update
+
+from cache import TTLCache
+from db import Database
+from metrics import SCHEDULER_WAIT_SECONDS
+
+OFFSET_KEY = "update_offset"
+
+
+def update_user_id(update: Update):
+    user = getattr(update.event, "from_user", None)
+    return user.id if user is not None else None
+
+
+# Offset and dedup bookkeeping shared by UpdateScheduler and Supervisor.
+# `offset` is the highest update_id up to which everything has been
+# processed; subclasses move it with _set_offset and count `pending`. With a
+# database it is checkpointed every `checkpoint_interval` seconds. After a
+# restart updates up to it are skipped, and recently seen ids are skipped
+# too, so redelivered updates are not handled twice.
+class UpdateOffset:
+    def __init__(
+        self,
+        db: Database = None,
+        checkpoint_interval: float = 1.0,
+        dedup_size: int = 100000,
+        dedup_ttl: float = 24 * 3600,
+    ):
+        self.db = db
+        self.checkpoint_interval = checkpoint_interval
+        self._seen = TTLCache(dedup_size, dedup_ttl)
+        self._last_submitted = None
+        self.offset = None  # Everything up to this update_id is processed
+        self._progress = asyncio.Event()  # Set when the offset moves
+        self._saved_offset = None
+        self._restored = None
+        self.duplicates = 0
+
+    # Loads the checkpointed offset, call before the first submit
+    async def restore(self):
+        if self.db is not None:
+            value = await self.db.get_bot_state(OFFSET_KEY)
+            if value is not None:
+                self.offset = self._saved_offset = self._last_submitted = self._restored = int(value)
+        return self.offset
+
+    # True for an update submitted before; remembers the others
+    def _duplicate(self, update_id):
+        # Only the restored offset is a hard floor: webhook updates may arrive out of order
+        if (self._restored is not None and update_id <= self._restored) or self._seen.get(update_id):
+            # Polling fetches updates again until they are processed, those are no redeliveries
+            if self.offset is not None and update_id <= self.offset:
+                self.duplicates += 1
+            return True
+        self._seen.set(update_id, True)
+        return False
+
+    def _set_offset(self, offset):
+        if offset != self.offset:
+            self.offset = offset
+            self._progress.set()
+
+    # Returns once the offset has moved on from `offset`, or after `timeout` seconds
+    async def wait_progress(self, offset, timeout: float):
+        if self.offset != offset:
+            return
+        self._progress.clear()
+        try:
+            await asyncio.wait_for(self._progress.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def checkpoint(self):
+        if self.db is not None and self.offset is not None and self.offset != self._saved_offset:
+            self._saved_offset = self.offset
+            await self.db.set_bot_state(OFFSET_KEY, str(self.offset))
+
+    async def _checkpoint_loop(self):
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            try:
+                await self.checkpoint()
+            except Exception as e:
+                logging.error(f"Failed to checkpoint the update offset: {e}")
+
+    # Waits until every submitted update is processed
+    async def drain(self, timeout: float = 30.0):
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+
+# Runs updates of different users in parallel on a bounded pool of worker
+# tasks while each user's updates are handled strictly one after another,
+# in arrival order, so FSM transitions of one Form never race.
+#
+# Updates waiting here are only in memory. Polling confirms nothing past
+# `offset` to Telegram (see fetch_updates), so after a crash Telegram
+# delivers them again. In webhook mode Telegram got its 200 when they were
+# submitted, and up to max_pending of them are lost with the process.
+class UpdateScheduler(UpdateOffset):
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        workers: int = 64,
+        max_pending: int = 10000,
+        db: Database = None,
+        checkpoint_interval: float = 1.0,
+        dedup_size: int = 100000,
+        dedup_ttl: float = 24 * 3600,
+    ):
+        super().__init__(db, checkpoint_interval, dedup_size, dedup_ttl)
+        self.dp = dp
+        self.bot = bot
+        self.workers = workers
+        self.max_pending = max_pending
+        # Submitted update ids not processed yet, and finished ones still in the heap
+        self._inflight = []
+        self._finished = set()
+        # user key -> deque of (update, enqueued_at); a key is present while
+        # the user has updates queued or one in progress
+        self._queues = {}
+        self._ready = asyncio.Queue()
+        self._capacity = asyncio.Condition()
+        self._tasks = []
+        self.pending = 0
+        self.max_depth = 0
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            if self.db is not None:
+                self._tasks.append(asyncio.create_task(self._checkpoint_loop()))
+
+    # Waits while the scheduler is full, so a fast producer gets backpressure.
+    # Returns False for an update it already has.
+    async def submit(self, update: Update):
+        self.start()
+        update_id = update.update_id
+        if self._duplicate(update_id):
+            return False
+        if self.pending >= self.max_pending:
+            async with self._capacity:
+                await self._capacity.wait_for(lambda: self.pending < self.max_pending)
+
+        user_id = update_user_id(update)
+        # Updates without a user have nothing to be ordered with
+        key = user_id if user_id is not None else ("update", update.update_id)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            self._ready.put_nowait(key)
+        queue.append((update, time.monotonic()))
+        heapq.heappush(self._inflight, update_id)
+        self._last_submitted = max(update_id, self._last_submitted or update_id)
+        self.pending += 1
+        self.max_depth = max(self.max_depth, self.pending)
+        return True
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._queues[key]
+            update, enqueued_at = queue.popleft()
+            SCHEDULER_WAIT_SECONDS.observe(time.monotonic() - enqueued_at)
+            try:
+                response = await self.dp.feed_update(self.bot, update)
+                if isinstance(response, TelegramMethod):
+                    await self.dp.silent_call_request(bot=self.bot, result=response)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logging.exception(f"Update {update.update_id} failed: {e}")
+            finally:
+                self.pending -= 1
+                self._finish(update.update_id)
+                if queue:
+                    # Back of the line, so one busy user cannot starve the others
+                    self._ready.put_nowait(key)
+                else:
+                    del self._queues[key]
+                async with self._capacity:
+                    self._capacity.notify_all()
+
+    # Failed updates count as processed too: retrying them would fail again
+    def _finish(self, update_id):
+        self._finished.add(update_id)
+        while self._inflight and self._inflight[0] in self._finished:
+            self._finished.remove(heapq.heappop(self._inflight))
+        self._set_offset(self._inflight[0] - 1 if self._inflight else self._last_submitted)
+
+    async def close(self, timeout: float = 30.0):
+        await self.drain(timeout)
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        await self.checkpoint()
+
+    def stats(self):
+        return {
+            "pending": self.pending,
+            "users": len(self._queues),
+            "max_depth": self.max_depth,
+            "processed": self.processed,
+            "failed": self.failed,
+            "duplicates": self.duplicates,
+            "offset": self.offset,
+        }
+
+
+# One getUpdates call, submitting what it returns to the scheduler. Telegram
+# forgets every update below the offset it is sent, so it is the first one
+# the scheduler has not processed: updates in progress come back and are
+# skipped, and none is confirmed before it was handled. Returns the number
+# of updates fetched and how many of them were new.
+async def fetch_updates(bot: Bot, scheduler: UpdateOffset, allowed_updates=None, limit: int = 100, timeout: int = 0):
+    offset = scheduler.offset + 1 if scheduler.offset is not None else None
+    updates = await bot.get_updates(
+        offset=offset,
+        limit=limit,
+        timeout=timeout,
+        allowed_updates=allowed_updates,
+        request_timeout=timeout + 10
+    )
+    new = 0
+    for update in updates:
+        new += await scheduler.submit(update)
+    return len(updates), new
+
+
+# Fetches the updates that queued up while the bot was down and runs them
+# through the scheduler before polling starts. Returns the number of updates
+# and the seconds it took.
+async def drain_backlog(bot: Bot, scheduler: UpdateOffset, allowed_updates=None, batch: int = 100):
+    started = time.monotonic()
+    count = 0
+    while True:
+        offset = scheduler.offset
+        fetched, new = await fetch_updates(bot, scheduler, allowed_updates, batch)
+        count += new
+        # Telegram has nothing the scheduler did not get
+        if fetched < batch and not new:
+            break
+        if not new:
+            await scheduler.wait_progress(offset, 1.0)
+    await scheduler.drain()
+    await scheduler.checkpoint()
+    return count, time.monotonic() - started
+
+
+# Long polling that hands every update to the scheduler instead of running it.
+# At most `limit` unprocessed updates are fetched at a time: when a call only
+# brings updates in progress, it waits for the scheduler to finish some.
+async def poll_updates(bot: Bot, scheduler: UpdateOffset, allowed_updates=None, timeout: int = 30, limit: int = 100):
+    backoff = 1.0
+    while True:
+        offset = scheduler.offset
+        try:
+            fetched, new = await fetch_updates(bot, scheduler, allowed_updates, limit, timeout)
+        except Exception as e:
+            logging.error(f"Failed to fetch updates: {e}, retrying in {backoff:.0f}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+            continue
+        backoff = 1.0
+        if fetched and not new:
+            await scheduler.wait_progress(offset, timeout)
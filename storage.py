@@ -0,0 +1,201 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from cache import TTLCache
+from db import CONTROL_STATEMENTS
+from metrics import DB_SECONDS
+
+
+# FSM storage persisted in SQLite, so half-filled forms survive restarts and
+# can be shared between worker processes. Writes are buffered and flushed in
+# batches; records untouched for `session_ttl` seconds are expired.
+class SQLiteStorage(BaseStorage):
+    def __init__(
+        self,
+        path: str,
+        key_builder: Optional[KeyBuilder] = None,
+        flush_interval: float = 0.05,
+        batch_size: int = 500,
+        session_ttl: float = 7 * 24 * 3600,
+        sweep_interval: float = 600.0,
+        cache_size: int = 10000,
+    ):
+        self.path = path
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.session_ttl = session_ttl
+        self.sweep_interval = sweep_interval
+        # Records waiting to be written: key -> (state, data, updated_at)
+        self._pending: Dict[str, tuple] = {}
+        # Recently read or written records: key -> (state, data)
+        self._records = TTLCache(cache_size, session_ttl)
+        self._flush_event = asyncio.Event()  # A full batch is waiting
+        self._wake = asyncio.Event()  # Something is buffered
+        self._flush_task = None
+        self._last_sweep = time.monotonic()
+        self._conn = None
+        self.queries = 0  # Statements executed, bookkeeping aside, for benchmarks and metrics
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm")
+        self._executor.submit(self._open)
+
+    def _open(self):
+        self._conn = sqlite3.connect(self.path)
+        self._conn.set_trace_callback(self._count_query)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS fsm (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at REAL NOT NULL
+        )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_updated_at ON fsm(updated_at)")
+        self._conn.commit()
+
+    def _count_query(self, statement):
+        if not statement.lstrip()[:9].upper().startswith(CONTROL_STATEMENTS):
+            self.queries += 1
+
+    def _timed(self, fn, *args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, "fsm" + fn.__name__)
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._timed, fn, *args)
+
+    def _load(self, key):
+        row = self._conn.execute(
+            "SELECT state, data, updated_at FROM fsm WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[2] < time.time() - self.session_ttl:
+            return None, {}
+        return row[0], json.loads(row[1]) if row[1] else {}
+
+    async def _get_record(self, key):
+        pending = self._pending.get(key)
+        if pending is not None:
+            return pending[0], pending[1]
+        record = self._records.get(key)
+        if record is None:
+            record = await self._run(self._load, key)
+            if key in self._pending:
+                # Written while we were loading, the new record wins
+                return self._pending[key][:2]
+            self._records.set(key, record)
+        return record
+
+    def _put_record(self, key, state, data):
+        self._records.set(key, (state, data))
+        self._pending[key] = (state, data, time.time())
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        self._wake.set()
+        if len(self._pending) >= self.batch_size:
+            self._flush_event.set()
+
+    def _write(self, batch):
+        upserts = [
+            (key, state, json.dumps(data, ensure_ascii=False), updated_at)
+            for key, (state, data, updated_at) in batch.items()
+            if state is not None or data
+        ]
+        deletes = [(key,) for key, (state, data, _) in batch.items() if state is None and not data]
+        with self._conn:
+            if upserts:
+                self._conn.executemany(
+                    """INSERT INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET
+                        state = excluded.state, data = excluded.data, updated_at = excluded.updated_at""",
+                    upserts
+                )
+            if deletes:
+                self._conn.executemany("DELETE FROM fsm WHERE key = ?", deletes)
+
+    def _sweep(self):
+        with self._conn:
+            cur = self._conn.execute(
+                "DELETE FROM fsm WHERE updated_at < ?", (time.time() - self.session_ttl,)
+            )
+        return cur.rowcount
+
+    def _close(self):
+        self._conn.close()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        try:
+            await self._run(self._write, batch)
+        except Exception:
+            # Keep the records so the next flush retries them, unless newer ones arrived
+            for key, record in batch.items():
+                self._pending.setdefault(key, record)
+            raise
+
+    async def _flush_loop(self):
+        while True:
+            if not self._pending:
+                # Idle until the next write; expired sessions are swept then
+                self._wake.clear()
+                await self._wake.wait()
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            try:
+                await self.flush()
+                if time.monotonic() - self._last_sweep >= self.sweep_interval:
+                    self._last_sweep = time.monotonic()
+                    expired = await self._run(self._sweep)
+                    if expired:
+                        logging.info("Expired %s FSM sessions", expired)
+            except Exception as e:
+                logging.error(f"FSM storage flush error: {e}")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        storage_key = self.key_builder.build(key)
+        _, data = await self._get_record(storage_key)
+        self._put_record(storage_key, state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._get_record(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            msg = f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            raise DataNotDictLikeError(msg)
+        storage_key = self.key_builder.build(key)
+        state, _ = await self._get_record(storage_key)
+        self._put_record(storage_key, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._get_record(self.key_builder.build(key))
+        return data.copy()
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,284 @@
+import asyncio
+import heapq
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiogram import Bot
+from aiogram.types import Update
+
+from db import Database
+from metrics import REGISTRY
+from scheduler import UpdateOffset, UpdateScheduler, update_user_id
+
+
+def shard_of(user_id: int, workers: int) -> int:
+    return user_id % workers
+
+
+# Runs the bot in `workers` processes. Updates are routed by user, so all of
+# one user's updates, and with them their whole Form, go to the same worker,
+# whose scheduler keeps them in order. Workers share the SQLite files: their
+# writes to the main database take turns on one lock (Database.write_lock),
+# and FSM records never clash since every user lives on one worker.
+#
+# Updates travel to a worker as JSON over a pipe that outlives the process,
+# and a worker only takes as many off it as its scheduler has room for. A
+# crashed worker is restarted and picks up what was queued for it. The
+# offset only moves past updates the workers report as processed, and
+# polling confirms nothing beyond it to Telegram (see fetch_updates):
+# after a supervisor crash Telegram delivers the rest again, and the ids a
+# crashed worker had taken are forgotten, so the next poll hands them over
+# again. Those it handled but had not reported yet run twice. In webhook
+# mode Telegram got its 200 on submit: a crashed worker loses the updates
+# it had taken, at most its scheduler's max_pending, and a crashed
+# supervisor everything queued.
+#
+# Workers report their scheduler stats and a snapshot of their metrics every
+# second; the supervisor's /metrics serves those with a worker label.
+class Supervisor(UpdateOffset):
+    def __init__(
+        self,
+        target,
+        workers: int,
+        db: Database = None,
+        max_pending: int = 1000,
+        checkpoint_interval: float = 1.0,
+        restart_delay: float = 1.0,
+        dedup_size: int = 100000,
+        dedup_ttl: float = 24 * 3600,
+    ):
+        super().__init__(db, checkpoint_interval, dedup_size, dedup_ttl)
+        # Runs in each worker process as target(index, updates, stats, write_lock)
+        self.target = target
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self._context = multiprocessing.get_context("spawn")
+        self.write_lock = self._context.Lock()
+        if db is not None:
+            db.write_lock = self.write_lock
+        # Per worker: (reader, writer) of its update pipe, the updates waiting
+        # to be written to it, its process and the last stats it reported
+        self._pipes = [self._context.Pipe(duplex=False) for _ in range(workers)]
+        self._feeds = [asyncio.Queue(max_pending) for _ in range(workers)]
+        self._processes = [None] * workers
+        self._stats_readers = [None] * workers
+        self.worker_stats = [{} for _ in range(workers)]
+        # Ids handed to each worker and not reported as processed yet
+        self._outstanding = [[] for _ in range(workers)]
+        self.dispatched = [0] * workers
+        self.restarts = [0] * workers
+        # Pipe writes block once the worker falls behind, so they get threads
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="feed")
+        self._feeders = []
+        self._tasks = []
+
+    # Loads the checkpointed offset and starts the workers, so the leader's
+    # startup work runs before the first update
+    async def restore(self):
+        offset = await super().restore()
+        self.start()
+        return offset
+
+    @property
+    def pending(self):
+        return sum(map(len, self._outstanding))
+
+    def start(self):
+        if self._feeders:
+            return
+        for index in range(self.workers):
+            self._spawn(index)
+        self._feeders = [asyncio.create_task(self._feed(index)) for index in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._monitor())]
+        if self.db is not None:
+            self._tasks.append(asyncio.create_task(self._checkpoint_loop()))
+
+    def _spawn(self, index):
+        stats_reader, stats_writer = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=self.target,
+            args=(index, self._pipes[index][0], stats_writer, self.write_lock),
+            name=f"worker-{index}",
+            daemon=True
+        )
+        # The worker reads its configuration from the environment on import
+        os.environ["WORKERS"] = str(self.workers)
+        os.environ["WORKER_INDEX"] = str(index)
+        try:
+            process.start()
+        finally:
+            del os.environ["WORKER_INDEX"]
+        stats_writer.close()
+        self._processes[index] = process
+        self._stats_readers[index] = stats_reader
+        asyncio.get_running_loop().add_reader(stats_reader.fileno(), self._read_stats, index, stats_reader)
+        logging.info("Started worker %s (pid %s)", index, process.pid)
+
+    def _read_stats(self, index, reader):
+        try:
+            while reader.poll():
+                self.worker_stats[index], metrics = reader.recv()
+                REGISTRY.remote[(("worker",), (str(index),))] = metrics
+        except (EOFError, OSError):
+            self._close_stats(index, reader)
+        self._advance(index)
+
+    # Everything the worker got up to its reported offset is processed
+    def _advance(self, index):
+        processed = self.worker_stats[index].get("offset")
+        outstanding = self._outstanding[index]
+        while processed is not None and outstanding and outstanding[0] <= processed:
+            heapq.heappop(outstanding)
+        first = [ids[0] for ids in self._outstanding if ids]
+        self._set_offset(min(first) - 1 if first else self._last_submitted)
+
+    def _close_stats(self, index, reader):
+        if self._stats_readers[index] is reader:
+            self._stats_readers[index] = None
+        if not reader.closed:
+            asyncio.get_running_loop().remove_reader(reader.fileno())
+            reader.close()
+
+    # Waits while the worker's feed is full, so a fast producer gets backpressure.
+    # Returns False for an update it already has.
+    async def submit(self, update: Update):
+        self.start()
+        update_id = update.update_id
+        if self._duplicate(update_id):
+            return False
+        user_id = update_user_id(update)
+        # Updates without a user can go anywhere
+        index = shard_of(user_id if user_id is not None else update_id, self.workers)
+        payload = update.model_dump_json(exclude_none=True, by_alias=True).encode()
+        heapq.heappush(self._outstanding[index], update_id)
+        self._last_submitted = max(update_id, self._last_submitted or update_id)
+        await self._feeds[index].put(payload)
+        self.dispatched[index] += 1
+        return True
+
+    async def _feed(self, index):
+        loop = asyncio.get_running_loop()
+        feed = self._feeds[index]
+        writer = self._pipes[index][1]
+        while True:
+            payload = await feed.get()
+            try:
+                await loop.run_in_executor(self._executor, writer.send_bytes, payload)
+            except OSError as e:
+                logging.error(f"Failed to hand an update to worker {index}: {e}")
+            finally:
+                feed.task_done()
+            if not payload:
+                return
+
+    async def _monitor(self):
+        while True:
+            await asyncio.sleep(self.restart_delay)
+            for index, process in enumerate(self._processes):
+                if not process.is_alive():
+                    self.restarts[index] += 1
+                    logging.error("Worker %s exited with code %s, restarting", index, process.exitcode)
+                    self.worker_stats[index] = {}
+                    if self._stats_readers[index] is not None:
+                        self._close_stats(index, self._stats_readers[index])
+                    # The offset is still below what it had taken, so polling fetches it again
+                    for update_id in self._outstanding[index]:
+                        self._seen.invalidate(update_id)
+                    self._spawn(index)
+
+    # Workers stop after the updates queued before the empty stop message
+    async def close(self, timeout: float = 30.0):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._feeders:
+            deadline = time.monotonic() + timeout
+            for feed in self._feeds:
+                await feed.put(b"")
+            await asyncio.wait(self._feeders, timeout=timeout)
+            loop = asyncio.get_running_loop()
+            for index, process in enumerate(self._processes):
+                await loop.run_in_executor(None, process.join, max(deadline - time.monotonic(), 0))
+                if process.is_alive():
+                    logging.error("Worker %s did not stop in time, terminating it", index)
+                    process.terminate()
+                    await loop.run_in_executor(None, process.join)
+                reader = self._stats_readers[index]
+                if reader is not None:
+                    self._read_stats(index, reader)
+                    self._close_stats(index, reader)
+            # Unblocks pipe writes to workers that are gone
+            for reader, writer in self._pipes:
+                reader.close()
+                writer.close()
+            for task in self._feeders:
+                task.cancel()
+            self._feeders = []
+        self._executor.shutdown(wait=False)
+        await self.checkpoint()
+
+    def stats(self):
+        return {
+            "workers": [
+                {
+                    "alive": process is not None and process.is_alive(),
+                    "restarts": self.restarts[index],
+                    "dispatched": self.dispatched[index],
+                    "queued": self._feeds[index].qsize(),
+                    **self.worker_stats[index],
+                }
+                for index, process in enumerate(self._processes)
+            ],
+            "duplicates": self.duplicates,
+            "offset": self.offset,
+        }
+
+
+def _receive(reader, timeout, limit):
+    payloads = []
+    if reader.poll(timeout):
+        while len(payloads) < limit:
+            payloads.append(reader.recv_bytes())
+            if not payloads[-1] or not reader.poll():
+                break
+    return payloads
+
+
+# Worker side: runs the updates coming from the supervisor through the
+# worker's scheduler and reports its stats every `stats_interval` seconds,
+# until the stop message or the supervisor is gone
+async def serve_shard(
+    updates,
+    stats,
+    scheduler: UpdateScheduler,
+    bot: Bot,
+    stats_interval: float = 1.0,
+    batch: int = 100,
+):
+    loop = asyncio.get_running_loop()
+    parent = multiprocessing.parent_process()
+    reported = 0.0
+    running = True
+    while running:
+        # No more than the scheduler takes: what is still in the pipe survives a crash
+        limit = max(min(batch, scheduler.max_pending - scheduler.pending), 1)
+        payloads = await loop.run_in_executor(None, _receive, updates, stats_interval, limit)
+        for payload in payloads:
+            if not payload:
+                running = False
+                break
+            await scheduler.submit(Update.model_validate_json(payload, context={"bot": bot}))
+        if parent is not None and not parent.is_alive():
+            logging.error("Supervisor is gone, stopping")
+            running = False
+        if not running:
+            await scheduler.drain()
+        if not running or time.monotonic() - reported >= stats_interval:
+            reported = time.monotonic()
+            try:
+                stats.send((scheduler.stats(), REGISTRY.snapshot()))
+            except OSError:
+                pass